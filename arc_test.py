@@ -8,14 +8,18 @@
 # Models, checkpoints and logs in output file
 # System log in outputs
 
+# DISTRIBUTE sets the tf.distribute strategy (none, mirrored or multi_worker, one SLURM task per worker).
+# CONCURRENT trains both unets at the same time in separate processes.
+
 # Imports
 from pathlib import Path
 import hydra
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 import logging
 from unet_compare.real_unet import real_main
 from unet_compare.comp_unet import comp_main
 from unet_compare.functions import get_brains, mask_gen
+from unet_compare.distribute import get_strategy, train_concurrently
 import tensorflow as tf
 
 # Import settings with hydra
@@ -29,6 +33,10 @@ def main(cfg: DictConfig):
     cfg = cfg["configs"]
     ADDR = Path.cwd()
 
+    # Sets up the strategy before TF initializes its devices
+    if not cfg["params"].get("CONCURRENT", False):
+        get_strategy(cfg)
+
     # Initial logging
     print("Num GPUs Available: ", len(tf.config.list_physical_devices('GPU')))
     logging.info("Settings version: " + str(cfg["params"]["UNIT_CONFIRM"]))
@@ -36,6 +44,11 @@ def main(cfg: DictConfig):
     # Creates masks
     mask_gen(ADDR, cfg)
 
+    # Trains both models at once, the data is loaded once and shared with both processes
+    if cfg["params"].get("CONCURRENT", False):
+        train_concurrently(OmegaConf.to_container(cfg, resolve=True), ADDR)
+        return
+
     # Loads train, val data
     # Note: dec_train is not used because of image augmentation
     (
@@ -0,0 +1,44 @@
+# Compares the fused and unfused CompConv2D paths: checks they agree, then times forward and forward/backward passes.
+
+# Usage:
+# python benchmarks/compconv.py --batch 8 --size 256 --channels 34 --repeats 20
+
+# Imports
+import argparse
+import numpy as np
+import tensorflow as tf
+from unet_compare.functions import CompConv2D
+from complex_layers import bench_layer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--in_channels", type=int, default=34)
+    parser.add_argument("--channels", type=int, default=34)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    x = tf.random.normal((args.batch, args.size, args.size, 2 * args.in_channels))
+
+    # Both layers share weights, so outputs should match to float32 rounding
+    layer = CompConv2D(args.channels, fused=False)
+    fused = CompConv2D(args.channels, fused=True)
+    layer(x)
+    fused(x)
+    fused.set_weights(layer.get_weights())
+    diff = np.abs(layer(x).numpy() - fused(x).numpy()).max()
+    print("max abs difference: %.3e" % diff)
+
+    for name, lay in [("CompConv2D", layer), ("CompConv2D fused", fused)]:
+        bench_layer(name, lay, x, args.repeats)
+
+    return
+
+
+# Name guard
+if __name__ == "__main__":
+
+    # Runs the main program above
+    main()
@@ -0,0 +1,162 @@
+# Benchmarks the complex layers (complex_layers.py) against the layers the complex U-Net used before them.
+# Checks CompMaxPool2D and CompConv2DTranspose against complex-valued references, times every layer forward
+# and forward/backward, then times a training step of comp_unet_model with and without COMPLEX_LAYERS.
+# suite.py runs the same layer and U-Net benchmarks in its layers and models stages, so they land in its JSON.
+# Run alone, the results are printed and, with --out, written in the layout of suite.py's JSON.
+
+# Usage:
+# python benchmarks/complex_layers.py --batch 8 --size 128 --channels 34 --repeats 20 --out layers.json
+
+# Imports
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+from unet_compare.functions import CompConv2D, comp_unet_model, nrmse
+from unet_compare.complex_layers import (
+    CompMaxPool2D,
+    CompConv2DTranspose,
+    CReLU,
+    ModReLU,
+    CompBatchNorm,
+    CompConcatenate,
+)
+from timing import time_call, entry
+
+# comp_unet_model settings timed against the plain complex U-Net
+UNET_VARIANTS = [
+    ("comp_unet crelu", {"COMPLEX_LAYERS": True, "ACTIVATION": "crelu"}),
+    ("comp_unet modrelu", {"COMPLEX_LAYERS": True, "ACTIVATION": "modrelu"}),
+    ("comp_unet modrelu bn", {"COMPLEX_LAYERS": True, "ACTIVATION": "modrelu", "COMPLEX_BN": True}),
+]
+
+
+# Returns the complex tensor of a [real | imag] tensor.
+def to_complex(x):
+    real, imag = tf.split(x, 2, axis=-1)
+    return tf.complex(real, imag)
+
+
+# Max abs difference of CompMaxPool2D and CompConv2DTranspose from complex-valued references.
+def check(x):
+    z = to_complex(x).numpy()
+    b, h, w, c = z.shape
+    windows = z.reshape(b, h // 2, 2, w // 2, 2, c).transpose(0, 1, 3, 5, 2, 4).reshape(b, h // 2, w // 2, c, 4)
+    pick = np.take_along_axis(windows, np.abs(windows).argmax(axis=-1)[..., None], axis=-1)[..., 0]
+    pooled = to_complex(CompMaxPool2D()(x)).numpy()
+    print("CompMaxPool2D max abs difference: %.3e" % np.abs(pooled - pick).max())
+
+    up = CompConv2DTranspose(c)
+    out = to_complex(up(x))
+    real, imag = tf.split(x, 2, axis=-1)
+    bias_real, bias_imag = tf.split(up.bias, 2)
+    shape = [b, 2 * h, 2 * w, c]
+
+    # Complex conv2d_transpose isn't supported, the product is expanded by hand
+    def convt(u, kernel):
+        return tf.nn.conv2d_transpose(u, kernel, shape, 2)
+
+    ref = tf.complex(
+        convt(real, up.kernel_real) - convt(imag, up.kernel_imag) + bias_real,
+        convt(real, up.kernel_imag) + convt(imag, up.kernel_real) + bias_imag,
+    )
+    print("CompConv2DTranspose max abs difference: %.3e" % np.abs(out.numpy() - ref.numpy()).max())
+    return
+
+
+# Each new layer next to the one it replaces in comp_unet_model, as (name, layer, inputs).
+# The ReLU CompConv2D is left out, suite.py and compconv.py time it as "CompConv2D fused".
+def layer_pairs(x, channels):
+    return [
+        ("MaxPooling2D", layers.MaxPooling2D(pool_size=(2, 2)), x),
+        ("CompMaxPool2D", CompMaxPool2D(), x),
+        ("UpSampling2D", layers.UpSampling2D(size=(2, 2)), x),
+        ("CompConv2DTranspose", CompConv2DTranspose(channels), x),
+        ("concatenate", layers.Concatenate(axis=-1), [x, x]),
+        ("CompConcatenate", CompConcatenate(), [x, x]),
+        ("CompConv2D linear", CompConv2D(channels, fused=True, activation=None), x),
+        ("CReLU", CReLU(), x),
+        ("ModReLU", ModReLU(), x),
+        ("BatchNormalization", layers.BatchNormalization(), x),
+        ("CompBatchNorm", CompBatchNorm(), x),
+    ]
+
+
+# Forward and forward/backward result entries of a layer called on inputs.
+def bench_layer(name, lay, inputs, repeats):
+    batch = int(tf.nest.flatten(inputs)[0].shape[0])
+    forward = tf.function(lambda: lay(inputs))
+
+    @tf.function
+    def backward():
+        with tf.GradientTape() as tape:
+            tape.watch(inputs)
+            loss = tf.reduce_sum(lay(inputs))
+        return tape.gradient(loss, tf.nest.flatten(inputs) + lay.trainable_weights)
+
+    return [
+        entry("layers", name + " forward", time_call(forward, repeats), batch, "slices", batch=batch),
+        entry("layers", name + " backward", time_call(backward, repeats), batch, "slices", batch=batch),
+    ]
+
+
+# Training step result entries of comp_unet_model with each of variants' settings on top of cfg, at every batch size.
+def bench_unets(cfg, dec, rec, size, batches, repeats, variants=UNET_VARIANTS):
+    results = []
+
+    for name, params in variants:
+        model = comp_unet_model({"params": dict(cfg["params"], **params)}, H=size, W=size)
+        model.compile(optimizer=tf.keras.optimizers.Adam(cfg["params"].get("LR", 1e-3)), loss=nrmse)
+
+        for batch in batches:
+            x = dec[:batch]
+            y = rec[:batch]
+            seconds = time_call(lambda: model.train_on_batch(x, y), repeats)
+            results.append(
+                entry(
+                    "models", name + " train_step", seconds, len(x), "slices", batch=batch, params=model.count_params()
+                )
+            )
+
+        tf.keras.backend.clear_session()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--size", type=int, default=128)
+    parser.add_argument("--channels", type=int, default=34)
+    parser.add_argument("--mod", type=float, default=1.42)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+
+    x = tf.random.normal((args.batch, args.size, args.size, 2 * args.channels))
+    check(x)
+
+    results = []
+    for name, lay, inputs in layer_pairs(x, args.channels):
+        results += bench_layer(name, lay, inputs, args.repeats)
+
+    # A training step of the whole U-Net with the old and new layers
+    dec = np.random.standard_normal((args.batch, args.size, args.size, 2)).astype(np.float32)
+    cfg = {"params": {"MOD": args.mod, "FUSED": True}}
+    variants = [("comp_unet", {})] + UNET_VARIANTS
+    results += bench_unets(cfg, dec, dec, args.size, [args.batch], args.repeats, variants)
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump({"meta": {"args": vars(args)}, "results": results}, f, indent=2)
+        print("\nResults written to " + args.out)
+
+    return
+
+
+# Name guard
+if __name__ == "__main__":
+
+    # Runs the main program above
+    main()
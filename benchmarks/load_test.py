@@ -0,0 +1,42 @@
+# Load-tests a running reconstruction server (serve.py) with concurrent clients, prints latency and throughput.
+# Sends slices from a k-space .npy file, or random k-space if none is given.
+
+# Usage:
+# python benchmarks/load_test.py --clients 16 --requests 1000 --scan test/scan_0.npy
+
+# Imports
+import json
+import asyncio
+import argparse
+import numpy as np
+from unet_compare.server import load_test
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--scan", default=None, help="k-space .npy file, (slices, H, W, 2)")
+    parser.add_argument("--size", type=int, default=256, help="slice size of random k-space")
+    args = parser.parse_args()
+
+    if args.scan is not None:
+        slices = np.load(args.scan, mmap_mode="r")
+    else:
+        slices = np.random.standard_normal((16, args.size, args.size, 2))
+
+    result = asyncio.get_event_loop().run_until_complete(
+        load_test(slices, args.host, args.port, args.clients, args.requests)
+    )
+    print(json.dumps(result, indent=2))
+
+    return
+
+
+# Name guard
+if __name__ == "__main__":
+
+    # Runs the main program above
+    main()
@@ -0,0 +1,258 @@
+# Benchmark suite for the data pipeline, layers, models and metrics. Runs on CPU with synthetic k-space.
+# Each stage is timed separately and all results are written to one JSON file, tagged with the git commit.
+# Passing --baseline with an earlier results file prints the speed of every entry relative to it.
+
+# Usage:
+# python benchmarks/suite.py --size 256 --slices 64 --batches 1 4 16 --out bench.json
+# python benchmarks/suite.py --stages layers models --baseline bench.json --out bench_new.json
+
+# Imports
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Conv2D
+from unet_compare.functions import (
+    CompConv2D,
+    comp_unet_model,
+    real_unet_model,
+    nrmse,
+    mask_gen,
+    get_brains,
+    get_test,
+    data_aug,
+    data_pipeline,
+)
+from unet_compare.batch_metrics import batch_metrics
+from timing import time_call, entry
+from complex_layers import UNET_VARIANTS, layer_pairs, bench_layer, bench_unets
+
+STAGES = ["loading", "pipeline", "layers", "models", "metrics"]
+
+
+# Returns the benchmark settings, in the same layout as the yaml configs.
+def bench_cfg(args):
+    return {
+        "params": {
+            "NUM_TRAIN": args.slices,
+            "NUM_VAL": args.slices,
+            "NUM_TEST": args.slices,
+            "NUM_MASKS": 4,
+            "ACCEL": 5,
+            "SEED": 905,
+            "BATCH_SIZE": args.batches[0],
+            "MOD": 1.42,
+            "RE_MOD": 1.0,
+            "FUSED": True,
+            "LR": 0.001,
+            "BETA_1": 0.9,
+            "BETA_2": 0.999,
+        },
+        "addrs": {
+            "TRAIN": "train/*.npy",
+            "VAL": "val/*.npy",
+            "TEST": "test/*.npy",
+            "STATS": "stats.npy",
+            "MASK_SAVE": "masks",
+        },
+    }
+
+
+# Writes synthetic k-space scans, (slices, H, W, 2) per file, in the layout get_brains and get_test read.
+def write_scans(ADDR, args):
+    rng = np.random.RandomState(0)
+    for split in ["train", "val", "test"]:
+        os.makedirs(str(ADDR / split), exist_ok=True)
+        for ii in range(args.files):
+            img = rng.standard_normal((args.slices, args.size, args.size)).astype(np.float32)
+            kspace = np.fft.fft2(img * np.exp(1j * rng.uniform(0, np.pi, img.shape)))
+            np.save(str(ADDR / split / ("scan_%d.npy" % ii)), np.stack([kspace.real, kspace.imag], axis=3))
+    return
+
+
+# get_brains and get_test from disk, data caching off.
+def bench_loading(cfg, ADDR, args):
+    results = []
+
+    start = time.perf_counter()
+    mask_gen(ADDR, cfg)
+    results.append(entry("loading", "mask_gen", time.perf_counter() - start, cfg["params"]["NUM_MASKS"], "masks"))
+
+    seconds = time_call(lambda: get_brains(cfg, ADDR), args.repeats)
+    results.append(entry("loading", "get_brains", seconds, 2 * args.slices, "slices"))
+
+    seconds = time_call(lambda: get_test(cfg, ADDR), args.repeats)
+    results.append(entry("loading", "get_test", seconds, args.slices, "slices"))
+
+    return results
+
+
+# Batches per second from the data_aug generator and the tf.data pipeline.
+def bench_pipeline(cfg, mask, stats, rec_train, args):
+    results = []
+
+    for batch in args.batches:
+        cfg["params"]["BATCH_SIZE"] = batch
+
+        gen = data_aug(rec_train, mask, stats, cfg)
+        seconds = time_call(lambda: next(gen), args.repeats)
+        results.append(entry("pipeline", "data_aug", seconds, 1, "batches", batch=batch))
+
+        dataset = iter(data_pipeline(rec_train, mask, stats, cfg))
+        seconds = time_call(lambda: next(dataset), args.repeats)
+        results.append(entry("pipeline", "data_pipeline", seconds, 1, "batches", batch=batch))
+
+    return results
+
+
+# CompConv2D (unfused and fused) against a Conv2D with as many output channels, forward and forward/backward,
+# then each complex layer against the layer it replaces (see complex_layers.py).
+def bench_layers(args):
+    results = []
+    batch = args.batches[-1]
+    x = tf.random.normal((batch, args.size, args.size, 2 * args.channels))
+
+    layers = [
+        ("CompConv2D", CompConv2D(args.channels, fused=False)),
+        ("CompConv2D fused", CompConv2D(args.channels, fused=True)),
+        ("Conv2D", Conv2D(2 * args.channels, (3, 3), activation="relu", padding="same")),
+    ]
+    for name, lay, inputs in [(name, lay, x) for name, lay in layers] + layer_pairs(x, args.channels):
+        results += bench_layer(name, lay, inputs, args.repeats)
+
+    return results
+
+
+# One training step and predict throughput for both U-Nets at every batch size,
+# then a training step of the complex U-Net with the complex layers (see complex_layers.py).
+def bench_models(cfg, dec, rec, args):
+    results = []
+
+    for name, builder in [("comp_unet", comp_unet_model), ("real_unet", real_unet_model)]:
+        model = builder(cfg, H=args.size, W=args.size)
+        model.compile(optimizer=tf.keras.optimizers.Adam(cfg["params"]["LR"]), loss=nrmse)
+
+        for batch in args.batches:
+            x = dec[:batch]
+            y = rec[:batch]
+            seconds = time_call(lambda: model.train_on_batch(x, y), args.repeats)
+            results.append(entry("models", name + " train_step", seconds, len(x), "slices", batch=batch))
+
+            seconds = time_call(lambda: model.predict(dec, batch_size=batch), args.repeats)
+            results.append(entry("models", name + " predict", seconds, len(dec), "slices", batch=batch))
+
+        tf.keras.backend.clear_session()
+
+    results += bench_unets(cfg, dec, rec, args.size, args.batches, args.repeats, UNET_VARIANTS)
+
+    return results
+
+
+# batch_metrics over the test set, whole stack and chunked.
+def bench_metrics(ref, pred, args):
+    results = []
+
+    for chunk in [None] + args.batches:
+        seconds = time_call(lambda: batch_metrics(ref, pred, chunk), args.repeats)
+        results.append(entry("metrics", "batch_metrics", seconds, len(ref), "slices", chunk=chunk))
+
+    return results
+
+
+# Returns the current commit, or None outside a git checkout.
+def commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=str(Path(__file__).parent), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Prints each result as a speed ratio to the matching entry of an earlier results file, >1 is faster.
+def compare(results, baseline_path):
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+
+    def key(result):
+        return (result["stage"], result["name"], result.get("batch"), result.get("chunk"))
+
+    old = {key(result): result for result in baseline["results"]}
+    print("\nSpeed relative to " + str(baseline_path) + " (" + str(baseline["meta"].get("commit")) + "):")
+    for result in results:
+        if key(result) in old:
+            ratio = old[key(result)]["seconds"] / result["seconds"]
+            print("%-9s %-34s %-12s x%.2f" % (result["stage"], result["name"], key(result)[2:], ratio))
+
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--slices", type=int, default=64, help="slices per scan file and per split")
+    parser.add_argument("--files", type=int, default=2, help="scan files per split")
+    parser.add_argument("--channels", type=int, default=34, help="complex channels for the layer benchmark")
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument("--baseline", default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ADDR = Path(tmp)
+        cfg = bench_cfg(args)
+        write_scans(ADDR, args)
+
+        if "loading" in args.stages:
+            results += bench_loading(cfg, ADDR, args)
+        else:
+            mask_gen(ADDR, cfg)
+        mask, stats, dec_train, rec_train, _, _ = get_brains(cfg, ADDR)
+        dec_test, rec_test = get_test(cfg, ADDR)
+
+        if "pipeline" in args.stages:
+            results += bench_pipeline(cfg, mask, stats, rec_train, args)
+        if "layers" in args.stages:
+            results += bench_layers(args)
+        if "models" in args.stages:
+            results += bench_models(cfg, dec_test, rec_test, args)
+        if "metrics" in args.stages:
+            results += bench_metrics(rec_test, dec_test, args)
+
+    meta = {
+        "commit": commit(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "tensorflow": tf.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+    }
+    with open(args.out, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+    print("\nResults written to " + args.out)
+
+    if args.baseline is not None:
+        compare(results, args.baseline)
+
+    return
+
+
+# Name guard
+if __name__ == "__main__":
+
+    # Runs the main program above
+    main()
@@ -0,0 +1,26 @@
+# Timing helpers shared by the benchmarks, so every script reports comparable numbers.
+# Imported as a sibling module, the benchmarks are run as python benchmarks/<name>.py.
+
+# Imports
+import time
+import numpy as np
+
+
+# Times fn over a number of repeats after a warm up call, returns the median seconds per call.
+def time_call(fn, repeats):
+    fn()
+    times = np.zeros(repeats)
+    for ii in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times[ii] = time.perf_counter() - start
+    return float(np.median(times))
+
+
+# Returns one result entry, in the layout of suite.py's JSON, and prints it.
+# items is what one call processes (slices or batches), giving a rate per second.
+def entry(stage, name, seconds, items, unit, **extra):
+    result = {"stage": stage, "name": name, "seconds": seconds, "per_sec": items / seconds, "unit": unit}
+    result.update(extra)
+    print("%-9s %-34s %9.2f ms %10.1f %s/s" % (stage, name, seconds * 1e3, items / seconds, unit))
+    return result
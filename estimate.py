@@ -0,0 +1,42 @@
+# This program reports the cost of the models a settings file would train, without training them.
+# Parameter count, FLOPs per slice and activation memory per batch, see unet_compare/model_cost.
+
+# Inputs:
+# inputs/configs/settings_1 yaml file (DEPTH, CONVS, COMP_WIDTHS, REAL_WIDTHS, CASCADE, ...)
+# train, val or test datasets, only their slice shape is read
+
+# Outputs:
+# Cost of the complex and real models, in the system log in outputs
+
+# Imports
+from pathlib import Path
+import hydra
+from omegaconf import DictConfig
+from unet_compare.functions import model_builder, scan_shape, set_precision
+from unet_compare.model_cost import model_cost
+
+# Import settings with hydra
+@hydra.main(
+    version_base=None,
+    config_path="../UofC2022/inputs/configs",
+    config_name="settings_1",
+)
+def main(cfg: DictConfig):
+
+    # Finds working directory address, used with cfg addresses
+    ADDR = Path.cwd()
+
+    # Builds each model as training would, at the data's slice size
+    set_precision(cfg["params"].get("PRECISION", "float32"))
+    H, W = scan_shape(cfg, ADDR)
+    for kind, name in [("comp", "complex UNet"), ("real", "real UNet")]:
+        model = model_builder(cfg, kind)(cfg, H=H, W=W)
+        model_cost(model, cfg["params"]["BATCH_SIZE"], name)
+
+    return
+
+# Name guard
+if __name__ == "__main__":
+
+    # Runs the main program above
+    main()
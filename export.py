@@ -0,0 +1,54 @@
+# This program exports a trained model for inference only, see unet_compare/export.
+# A frozen SavedModel (optionally XLA-compiled) and optionally a float16 or int8 TFLite model,
+# each checked against the original on test slices and timed.
+# serve.py and recon_test.py load an export directory or .tflite file the same way as a Keras model.
+
+# Inputs:
+# test dataset, EXPORT_SLICES slices of it are used for the parity and latency checks
+# inputs/configs/test_settings yaml file
+# A trained model (EXPORT_MODEL)
+
+# Outputs:
+# savedmodel/, model.tflite and report.json in EXPORT_DIR
+# System log in outputs
+
+# Imports
+from pathlib import Path
+import hydra
+from omegaconf import DictConfig
+from unet_compare.functions import get_test, mask_gen
+from unet_compare.export import export_model
+
+# Import settings with hydra
+@hydra.main(
+    version_base=None,
+    config_path="../UofC2022/inputs/configs",
+    config_name="test_settings",
+)
+def main(cfg: DictConfig):
+
+    # Finds working directory address, used with cfg addresses
+    ADDR = Path.cwd()
+
+    # Creates masks, loads test slices for the checks
+    mask_gen(ADDR, cfg)
+    dec_test = get_test(cfg, ADDR)[0][: cfg["params"]["EXPORT_SLICES"]]
+
+    # Exports, checks and times the model
+    export_model(
+        ADDR / cfg["addrs"]["EXPORT_MODEL"],
+        ADDR / cfg["addrs"]["EXPORT_DIR"],
+        dec_test,
+        xla=cfg["params"]["EXPORT_XLA"],
+        tflite=cfg["params"]["EXPORT_TFLITE"],
+        batch_size=cfg["params"]["BATCH_SIZE"],
+        repeats=cfg["params"]["EXPORT_REPEATS"],
+    )
+
+    return
+
+# Name guard
+if __name__ == "__main__":
+
+    # Runs the main program above
+    main()
@@ -0,0 +1,32 @@
+# This program converts whole-volume scans to the sharded format read by get_brains and get_test.
+# Each split becomes a directory of fixed-size float32 shards plus an index.json, point TRAIN/VAL/TEST at it.
+
+# Usage:
+# python make_shards.py "train/*.npy" train_shards --shard_slices 64
+# python make_shards.py "test/*.npy" test_shards --compress
+
+# Imports
+import glob
+import argparse
+from unet_compare.shards import convert
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scans", help="glob of (slices, H, W, 2) .npy volumes")
+    parser.add_argument("out", help="shard directory to write")
+    parser.add_argument("--shard_slices", type=int, default=64)
+    parser.add_argument("--compress", action="store_true", help="compressed .npz shards, read whole")
+    args = parser.parse_args()
+
+    store = convert(glob.glob(args.scans), args.out, args.shard_slices, args.compress)
+    print("%d slices in %d shards written to %s" % (len(store), len(store.paths), args.out))
+
+    return
+
+
+# Name guard
+if __name__ == "__main__":
+
+    # Runs the main program above
+    main()
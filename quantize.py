@@ -0,0 +1,58 @@
+# This program quantizes the trained complex and real U-Nets to int8 and reports the cost in accuracy,
+# see unet_compare/quantize.
+
+# Inputs:
+# test dataset, the first QUANT_CALIBRATION slices calibrate the quantization, the rest are for the report
+# inputs/configs/test_settings yaml file
+# Trained models (QUANT_COMP_MODEL, QUANT_REAL_MODEL)
+
+# Outputs:
+# comp_int8.tflite, real_int8.tflite and quant_report.json in QUANT_DIR
+# Metrics, latency, size and tolerance check in the system log in outputs
+
+# Imports
+from pathlib import Path
+import hydra
+from omegaconf import DictConfig
+from unet_compare.functions import get_test, mask_gen
+from unet_compare.quantize import quant_report
+
+# Import settings with hydra
+@hydra.main(
+    version_base=None,
+    config_path="../UofC2022/inputs/configs",
+    config_name="test_settings",
+)
+def main(cfg: DictConfig):
+
+    # Finds working directory address, used with cfg addresses
+    ADDR = Path.cwd()
+
+    # Creates masks, loads test slices and splits off the calibration slices
+    mask_gen(ADDR, cfg)
+    dec_test, rec_test = get_test(cfg, ADDR)[:2]
+    num = cfg["params"]["QUANT_CALIBRATION"]
+
+    # Quantizes both models and compares them with float32
+    quant_report(
+        [
+            ("comp", ADDR / cfg["addrs"]["QUANT_COMP_MODEL"]),
+            ("real", ADDR / cfg["addrs"]["QUANT_REAL_MODEL"]),
+        ],
+        ADDR / cfg["addrs"]["QUANT_DIR"],
+        dec_test[:num],
+        dec_test[num:],
+        rec_test[num:],
+        ssim_tol=cfg["params"]["QUANT_SSIM_TOL"],
+        psnr_tol=cfg["params"]["QUANT_PSNR_TOL"],
+        batch_size=cfg["params"]["BATCH_SIZE"],
+        repeats=cfg["params"]["EXPORT_REPEATS"],
+    )
+
+    return
+
+# Name guard
+if __name__ == "__main__":
+
+    # Runs the main program above
+    main()
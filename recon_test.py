@@ -0,0 +1,47 @@
+# This program reconstructs the test set with one trained model, streaming it in micro-batches.
+# Memory use stays the same whatever the number of slices, the reconstructions are written to a .npy file.
+
+# Inputs:
+# test dataset
+# inputs/configs/test_settings yaml file
+# A trained model or an export from export.py (RECON_MODEL)
+
+# Outputs:
+# Reconstructions as a (slices, H, W, 2) .npy file (RECON_OUT)
+# System log in outputs
+
+# Imports
+from pathlib import Path
+import hydra
+from omegaconf import DictConfig
+from unet_compare.functions import mask_gen
+from unet_compare.export import load_inference_model
+from unet_compare.inference import reconstruct_test
+
+# Import settings with hydra
+@hydra.main(
+    version_base=None,
+    config_path="../UofC2022/inputs/configs",
+    config_name="test_settings",
+)
+def main(cfg: DictConfig):
+
+    # Finds working directory address, used with cfg addresses
+    ADDR = Path.cwd()
+
+    # Creates masks
+    mask_gen(ADDR, cfg)
+
+    # Loads the model
+    model = load_inference_model(ADDR / cfg["addrs"]["RECON_MODEL"])
+
+    # Reconstructs every test slice
+    reconstruct_test(cfg, ADDR, model, ADDR / cfg["addrs"]["RECON_OUT"])
+
+    return
+
+# Name guard
+if __name__ == "__main__":
+
+    # Runs the main program above
+    main()
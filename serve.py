@@ -0,0 +1,51 @@
+# This program serves a trained model as a local reconstruction service.
+# Undersampled k-space slices are sent over TCP and grouped into micro-batches, see unet_compare/server.
+# benchmarks/load_test.py load-tests a running server.
+
+# Inputs:
+# inputs/configs/test_settings yaml file
+# A trained model or an export from export.py (SERVE_MODEL)
+
+# Outputs:
+# System log in outputs, including p50/p99 latency and throughput on shutdown
+
+# Imports
+import asyncio
+from pathlib import Path
+import hydra
+from omegaconf import DictConfig
+from unet_compare.functions import mask_input
+from unet_compare.server import serve
+
+# Import settings with hydra
+@hydra.main(
+    version_base=None,
+    config_path="../UofC2022/inputs/configs",
+    config_name="test_settings",
+)
+def main(cfg: DictConfig):
+
+    # Finds working directory address, used with cfg addresses
+    ADDR = Path.cwd()
+
+    # Serves until interrupted
+    try:
+        asyncio.get_event_loop().run_until_complete(
+            serve(
+                ADDR / cfg["addrs"]["SERVE_MODEL"],
+                port=cfg["params"].get("SERVE_PORT", 8765),
+                max_batch=cfg["params"].get("SERVE_BATCH", 16),
+                max_latency=cfg["params"].get("SERVE_LATENCY", 10) / 1000.0,
+                with_mask=mask_input(cfg),
+            )
+        )
+    except KeyboardInterrupt:
+        pass
+
+    return
+
+# Name guard
+if __name__ == "__main__":
+
+    # Runs the main program above
+    main()
@@ -0,0 +1,37 @@
+# This program runs a hyperparameter sweep on one node, see unet_compare/sweep.
+
+# Inputs:
+# train, val datasets
+# inputs/configs/sweep_settings yaml file, the sweep section lists the values to try
+
+# Outputs:
+# One model per trial and sweep.json with every trial's val_loss per rung, in SWEEP_DIR
+# System log in outputs
+
+# Imports
+from pathlib import Path
+import hydra
+from omegaconf import DictConfig, OmegaConf
+from unet_compare.sweep import run_sweep
+
+# Import settings with hydra
+@hydra.main(
+    version_base=None,
+    config_path="../UofC2022/inputs/configs",
+    config_name="sweep_settings",
+)
+def main(cfg: DictConfig):
+
+    # Finds working directory address, used with cfg addresses
+    ADDR = Path.cwd()
+
+    # Loads data once per ACCEL, trains and prunes the trials
+    run_sweep(OmegaConf.to_container(cfg, resolve=True), ADDR)
+
+    return
+
+# Name guard
+if __name__ == "__main__":
+
+    # Runs the main program above
+    main()
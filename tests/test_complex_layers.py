@@ -0,0 +1,27 @@
+# Builds and runs the complex U-Net with COMPLEX_BN in half precision, training and inference.
+
+import numpy as np
+import tensorflow as tf
+from unet_compare.functions import comp_unet_model, inference_copy, set_precision
+
+CFG = {"params": {"MOD": 0.5, "FUSED": True, "COMPLEX_LAYERS": True, "ACTIVATION": "modrelu", "COMPLEX_BN": True}}
+
+
+def test_complex_bn_mixed_float16():
+    x = np.random.standard_normal((2, 32, 32, 2)).astype(np.float32)
+    set_precision("mixed_float16")
+    try:
+        model = comp_unet_model(CFG, H=32, W=32)
+        assert np.all(np.isfinite(model(x, training=True).numpy()))
+        assert np.all(np.isfinite(model(x, training=False).numpy()))
+    finally:
+        set_precision("float32")
+        tf.keras.backend.clear_session()
+
+
+def test_complex_bn_inference_copy_float16():
+    x = np.random.standard_normal((2, 32, 32, 2)).astype(np.float32)
+    model = comp_unet_model(CFG, H=32, W=32)
+    half = inference_copy(model, comp_unet_model, CFG, "float16")
+    assert half(x, training=False).shape == (2, 32, 32, 2)
+    tf.keras.backend.clear_session()
@@ -0,0 +1,56 @@
+# Batched SSIM, NRMSE and PSNR for whole (N, H, W, 2) stacks at once.
+# SSIM uses 7x7 uniform windows per channel, the same definition as skimage's structural_similarity,
+# with all window statistics of a chunk taken by a single TF average pool.
+
+from collections import namedtuple
+import numpy as np
+import tensorflow as tf
+
+# Per slice results, each field is an (N,) array
+Metrics = namedtuple("Metrics", ["ssim", "nrmse", "psnr"])
+
+
+# SSIM, NRMSE and PSNR for one chunk of float32 slices.
+@tf.function
+def chunk_metrics(x, y, win=7, K1=0.01, K2=0.03):
+    cov_norm = win * win / (win * win - 1.0)
+
+    # Window means of x, y, x^2, y^2 and xy, one pool for all of them
+    means = tf.nn.avg_pool2d(
+        tf.concat([x, y, x * x, y * y, x * y], axis=3), win, strides=1, padding="VALID"
+    )
+    ux, uy, uxx, uyy, uxy = tf.split(means, 5, axis=3)
+    vx = cov_norm * (uxx - ux * ux)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - ux * uy)
+
+    data_range = tf.reduce_max(x, axis=(1, 2, 3)) - tf.reduce_min(x, axis=(1, 2, 3))
+    C1 = tf.reshape((K1 * data_range) ** 2, (-1, 1, 1, 1))
+    C2 = tf.reshape((K2 * data_range) ** 2, (-1, 1, 1, 1))
+    S = ((2 * ux * uy + C1) * (2 * vxy + C2)) / ((ux * ux + uy * uy + C1) * (vx + vy + C2))
+    ssim = tf.reduce_mean(S, axis=(1, 2, 3))
+
+    mse = tf.reduce_mean(tf.square(x - y), axis=(1, 2, 3))
+    nrmse = tf.sqrt(mse) / tf.sqrt(tf.reduce_mean(tf.square(x), axis=(1, 2, 3)))
+    psnr = 10.0 * tf.math.log(data_range ** 2 / mse) / np.log(10.0)
+
+    return ssim, nrmse, psnr
+
+
+# Computes SSIM, NRMSE and PSNR for every slice of two (N, H, W, C) stacks.
+# chunk bounds how many slices are on the device at once, None does the whole stack in one go.
+def batch_metrics(ref, pred, chunk=None):
+    n = ref.shape[0]
+    chunk = n if chunk is None else chunk
+
+    result = Metrics(np.zeros(n), np.zeros(n), np.zeros(n))
+    for start in range(0, n, chunk):
+        end = min(start + chunk, n)
+        x = tf.convert_to_tensor(np.asarray(ref[start:end], dtype=np.float32))
+        y = tf.convert_to_tensor(np.asarray(pred[start:end], dtype=np.float32))
+        ssim, nrmse, psnr = chunk_metrics(x, y)
+        result.ssim[start:end] = ssim.numpy()
+        result.nrmse[start:end] = nrmse.numpy()
+        result.psnr[start:end] = psnr.numpy()
+
+    return result
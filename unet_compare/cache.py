@@ -0,0 +1,125 @@
+# On-disk cache of preprocessed dec/rec tensors, shared by every run that loads the same data.
+# An entry is keyed by a hash of the scan files (names, sizes, mtimes), the masks, the seed and the loading params.
+# Entries are written once, memory-mapped read-only on later runs, and evicted oldest first past CACHE_SIZE.
+
+import os
+import json
+import shutil
+import time
+import hashlib
+import logging
+import numpy as np
+
+# Params that change what the loaders return, for every split
+CACHE_PARAMS = ["NUM_MASKS", "ACCEL", "SEED", "LEAN_LOAD", "CASCADE"]
+
+# Params that only change what the loader of one split returns
+SPLIT_PARAMS = {"train": ["NUM_TRAIN"], "val": ["NUM_VAL"], "test": ["NUM_TEST"]}
+
+# Seconds after which a temporary entry left by an interrupted write is deleted
+STALE_TMP = 3600
+
+# Bumped whenever the loaders change what they return for the same inputs
+CACHE_VERSION = 3
+
+
+# Returns the cache directory, or None if caching is off.
+# Caching needs a CACHE address and a SEED, otherwise the loaded slices are not reproducible.
+def cache_dir(cfg, ADDR):
+
+    if cfg["addrs"].get("CACHE") is None or cfg["params"].get("SEED") is None:
+        return None
+
+    return ADDR / cfg["addrs"]["CACHE"]
+
+
+# Hashes everything that determines the contents of one cached split.
+def cache_key(cfg, name, files, mask):
+
+    key = hashlib.sha256()
+    key.update(("v%d|%s" % (CACHE_VERSION, name)).encode())
+    for f in sorted(files):
+        st = os.stat(f)
+        key.update(("\n%s|%d|%d" % (os.path.abspath(f), st.st_size, st.st_mtime_ns)).encode())
+    key.update(str(mask.shape).encode())
+    key.update(np.packbits(mask).tobytes())
+    params = {k: cfg["params"].get(k) for k in CACHE_PARAMS + SPLIT_PARAMS.get(name, [])}
+    key.update(json.dumps(params, sort_keys=True).encode())
+
+    return key.hexdigest()[:32]
+
+
+# Deletes the least recently used entries until the cache fits in CACHE_SIZE (GB).
+# Temporary entries of interrupted writes are deleted once stale, ones still being written count towards the size.
+def evict(root, size_gb, keep):
+
+    entries = []
+    writing = 0
+    for entry in os.listdir(root):
+        path = os.path.join(root, entry)
+        if not os.path.isdir(path) or entry == keep:
+            continue
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        if ".tmp" in entry:
+            # Files being written keep their mtime current
+            touched = max(
+                [os.path.getmtime(path)] + [os.path.getmtime(os.path.join(path, f)) for f in os.listdir(path)]
+            )
+            if time.time() - touched > STALE_TMP:
+                logging.info("cache stale write removed: " + path)
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                writing += size
+            continue
+        entries.append((os.path.getmtime(path), size, path))
+
+    total = writing + sum(e[1] for e in entries) + sum(
+        os.path.getsize(os.path.join(root, keep, f)) for f in os.listdir(os.path.join(root, keep))
+    )
+    for _, size, path in sorted(entries):
+        if total <= size_gb * 1e9:
+            break
+        logging.info("cache evict: " + path)
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+    return
+
+
+# Returns (dec, rec) for one split, from the cache if present, otherwise from build() and then cached.
+# Cached arrays are returned as read-only memory maps. dec may be None, it is then not cached.
+def cached_slices(cfg, ADDR, name, files, mask, build):
+
+    root = cache_dir(cfg, ADDR)
+    if root is None:
+        return build()
+
+    key = name + "_" + cache_key(cfg, name, files, mask)
+    path = root / key
+
+    if not path.is_dir():
+        logging.info("cache miss: " + key)
+        dec, rec = build()
+
+        # Written to a temporary directory then renamed, so concurrent jobs never see half an entry
+        os.makedirs(root, exist_ok=True)
+        tmp = root / (key + ".tmp" + str(os.getpid()))
+        os.makedirs(tmp, exist_ok=True)
+        if dec is not None:
+            np.save(str(tmp / "dec.npy"), dec.astype("float32", copy=False))
+        np.save(str(tmp / "rec.npy"), rec.astype("float32", copy=False))
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+        del dec, rec
+
+        evict(root, cfg["params"].get("CACHE_SIZE", 20), key)
+    else:
+        logging.info("cache hit: " + key)
+        os.utime(path)
+
+    dec = np.load(str(path / "dec.npy"), mmap_mode="r") if (path / "dec.npy").exists() else None
+    rec = np.load(str(path / "rec.npy"), mmap_mode="r")
+
+    return dec, rec
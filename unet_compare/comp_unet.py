@@ -5,11 +5,19 @@ import time
 from datetime import datetime
 import tensorflow as tf
 import logging
+import numpy as np
 from unet_compare.functions import (
-    comp_unet_model,
+    model_builder,
     nrmse,
-    data_aug,
+    train_input,
+    set_precision,
+    scale_loss,
+    inference_copy,
 )
+from unet_compare.profiling import profile_callback
+from unet_compare.model_cost import model_cost
+from unet_compare.distribute import get_strategy, is_chief, out_path
+from unet_compare.resume import ResumeCallback, resume_state, trim_log
 
 
 def comp_main(
@@ -27,40 +35,71 @@ def comp_main(
 
     # Declares, compiles the model.
     logging.info("Compiling UNet")
-    model = comp_unet_model(cfg)
-    opt = tf.keras.optimizers.Adam(
-        lr=cfg["params"]["LR"],
-        beta_1=cfg["params"]["BETA_1"],
-        beta_2=cfg["params"]["BETA_2"],
-    )
-    model.compile(optimizer=opt, loss=nrmse)
+    policy = set_precision(cfg["params"].get("PRECISION", "float32"))
+    logging.info("Precision policy: " + policy)
+    strategy = get_strategy(cfg)
+    builder = model_builder(cfg, "comp")
+    with strategy.scope():
+        model = builder(cfg, H=rec_train.shape[1], W=rec_train.shape[2])
+        opt = tf.keras.optimizers.Adam(
+            lr=cfg["params"]["LR"],
+            beta_1=cfg["params"]["BETA_1"],
+            beta_2=cfg["params"]["BETA_2"],
+        )
+        opt = scale_loss(opt, policy)
+        model.compile(optimizer=opt, loss=nrmse)
+    if is_chief(strategy):
+        model_cost(model, cfg["params"]["BATCH_SIZE"], "complex UNet")
+
+    # Picks up from the last resume checkpoint, if there is one
+    resume_dir, state = resume_state(cfg, ADDR, "COMP_RESUME", strategy)
+    initial_epoch = 0 if state is None else state["epoch"]
+    if state is not None:
+        trim_log(out_path(cfg, ADDR, "COMP_CSV", strategy), initial_epoch)
+    steps = int(np.ceil(rec_train.shape[0] / (cfg["params"]["BATCH_SIZE"] * strategy.num_replicas_in_sync)))
 
     # Callbacks to manage training
     mc = tf.keras.callbacks.ModelCheckpoint(
-        filepath=str(ADDR / cfg["addrs"]["COMP_CHEC"]),
+        filepath=str(out_path(cfg, ADDR, "COMP_CHEC", strategy)),
         mode="min",
         monitor="val_loss",
         save_best_only=True,
     )
     es = tf.keras.callbacks.EarlyStopping(monitor="val_loss", patience=20, mode="min")
     csvl = tf.keras.callbacks.CSVLogger(
-        str(ADDR / cfg["addrs"]["COMP_CSV"]), append=False, separator="|"
+        str(out_path(cfg, ADDR, "COMP_CSV", strategy)), append=state is not None, separator="|"
+    )
+    callbacks = [mc, es, csvl]
+    if resume_dir is not None:
+        callbacks.append(
+            ResumeCallback(resume_dir, cfg["params"]["RESUME_EVERY"], steps, es, mc, state)
+        )
+    prof = profile_callback(cfg, ADDR, "COMP_PROF", initial_epoch)
+    if prof is not None and is_chief(strategy):
+        callbacks.append(prof)
+    combined = train_input(
+        rec_train, mask, stats, cfg, strategy, start=0 if state is None else state["batches"]
     )
-    combined = data_aug(rec_train, mask, stats, cfg)
 
     # Fits model using training data, validation data
     logging.info("Fitting UNet")
-    model.fit_generator(
+    model.fit(
         combined,
         epochs=cfg["params"]["EPOCHS"],
-        steps_per_epoch=rec_train.shape[0] / cfg["params"]["BATCH_SIZE"],
+        initial_epoch=initial_epoch,
+        steps_per_epoch=steps,
         verbose=0,
         validation_data=(dec_val, rec_val),
-        callbacks=[mc, es, csvl],
+        callbacks=callbacks,
     )
 
     # Saves model
-    model.save(ADDR / cfg["addrs"]["COMP_MODEL"])
+    model.save(out_path(cfg, ADDR, "COMP_MODEL", strategy))
+
+    # Mixed precision runs also save a pure float16/bfloat16 copy for inference
+    if policy.startswith("mixed_") and is_chief(strategy):
+        half = inference_copy(model, builder, cfg, policy[len("mixed_"):])
+        half.save(str(ADDR / cfg["addrs"]["COMP_MODEL"]) + "_" + policy[len("mixed_"):])
 
     # Provides endtime logging info
     end_time = time.time()
@@ -0,0 +1,274 @@
+# Complex-valued layers for the complex U-Net, used alongside CompConv2D.
+# Tensors keep the CompConv2D layout: channels last as [real | imag], C complex channels in 2C real ones.
+# Layers work on a (..., 2, C) reshaped view of that layout rather than splitting and concatenating the halves,
+# and complex products are done as one real op with a block weight [[Wr, Wi], [-Wi, Wr]].
+
+import tensorflow as tf
+from tensorflow.keras import layers
+
+
+# Views a [real | imag] tensor as (..., 2, C).
+def as_pairs(x):
+    shape = tf.shape(x)
+    return tf.reshape(x, tf.concat([shape[:-1], [2, shape[-1] // 2]], axis=0))
+
+
+# Inverse of as_pairs.
+def from_pairs(x):
+    shape = tf.shape(x)
+    return tf.reshape(x, tf.concat([shape[:-2], [2 * shape[-1]]], axis=0))
+
+
+# Max pooling by complex magnitude. Each output is the complex value with the largest |z| in its window,
+# real and imaginary parts taken together. Windows are gathered with one space_to_depth.
+class CompMaxPool2D(layers.Layer):
+    def __init__(self, pool_size=2, **kwargs):
+        super(CompMaxPool2D, self).__init__(**kwargs)
+        self.pool_size = pool_size
+
+    def call(self, inputs):
+        p = self.pool_size
+        channels = inputs.shape[-1] // 2
+        x = tf.nn.space_to_depth(inputs, p)
+        shape = tf.shape(x)
+        x = tf.reshape(x, tf.concat([shape[:-1], [p * p, 2, channels]], axis=0))
+
+        # Squared magnitude is enough to pick the max
+        power = tf.reduce_sum(tf.square(x), axis=-2, keepdims=True)
+        pick = tf.one_hot(tf.argmax(power, axis=-3), p * p, axis=-3, dtype=x.dtype)
+        x = tf.reduce_sum(x * pick, axis=-3)
+
+        return tf.reshape(x, tf.concat([shape[:-1], [2 * channels]], axis=0))
+
+    def get_config(self):
+        config = {"pool_size": self.pool_size}
+        base_config = super(CompMaxPool2D, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+# Complex transposed convolution for upsampling, one conv2d_transpose with a block kernel.
+class CompConv2DTranspose(layers.Layer):
+    def __init__(self, out_channels, kshape=(2, 2), strides=2, **kwargs):
+        super(CompConv2DTranspose, self).__init__(**kwargs)
+        self.out_channels = int(out_channels)
+        self.kshape = tuple(kshape)
+        self.strides = strides
+
+    def build(self, input_shape):
+        in_channels = int(input_shape[-1]) // 2
+        # conv2d_transpose kernels are (kh, kw, out, in)
+        shape = self.kshape + (self.out_channels, in_channels)
+        self.kernel_real = self.add_weight("kernel_real", shape=shape, initializer="glorot_uniform")
+        self.kernel_imag = self.add_weight("kernel_imag", shape=shape, initializer="glorot_uniform")
+        self.bias = self.add_weight("bias", shape=(2 * self.out_channels,), initializer="zeros")
+        super(CompConv2DTranspose, self).build(input_shape)
+
+    def call(self, inputs):
+        real = tf.cast(self.kernel_real, inputs.dtype)
+        imag = tf.cast(self.kernel_imag, inputs.dtype)
+        # Output channels on axis 2 and input channels on axis 3, [R | I] -> [R Wr - I Wi | R Wi + I Wr]
+        kernel = tf.concat(
+            [tf.concat([real, -imag], axis=3), tf.concat([imag, real], axis=3)], axis=2
+        )
+        shape = tf.shape(inputs)
+        out_shape = tf.stack(
+            [shape[0], shape[1] * self.strides, shape[2] * self.strides, 2 * self.out_channels]
+        )
+        x = tf.nn.conv2d_transpose(inputs, kernel, out_shape, strides=self.strides, padding="SAME")
+        return tf.nn.bias_add(x, tf.cast(self.bias, inputs.dtype))
+
+    def compute_output_shape(self, input_shape):
+        h = None if input_shape[1] is None else input_shape[1] * self.strides
+        w = None if input_shape[2] is None else input_shape[2] * self.strides
+        return tf.TensorShape([input_shape[0], h, w, 2 * self.out_channels])
+
+    def get_config(self):
+        config = {"out_channels": self.out_channels, "kshape": self.kshape, "strides": self.strides}
+        base_config = super(CompConv2DTranspose, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+# CReLU, ReLU on the real and imaginary parts. Elementwise, so it needs no view of the layout.
+class CReLU(layers.Layer):
+    def call(self, inputs):
+        return tf.nn.relu(inputs)
+
+
+# modReLU, z * relu(|z| + b) / |z| with a learned bias b per complex channel. Keeps the phase of z.
+class ModReLU(layers.Layer):
+    def build(self, input_shape):
+        self.b = self.add_weight("b", shape=(int(input_shape[-1]) // 2,), initializer="zeros")
+        super(ModReLU, self).build(input_shape)
+
+    def call(self, inputs):
+        x = as_pairs(inputs)
+        magnitude = tf.sqrt(tf.reduce_sum(tf.square(x), axis=-2, keepdims=True) + 1e-7)
+        scale = tf.nn.relu(magnitude + tf.cast(self.b, x.dtype)) / magnitude
+        return from_pairs(x * scale)
+
+
+# Complex batch normalization (Trabelsi et al., Deep Complex Networks). Whitens each complex channel with the
+# inverse square root of its 2x2 real/imag covariance, then applies a learned 2x2 scale and complex shift.
+class CompBatchNorm(layers.Layer):
+    def __init__(self, momentum=0.99, epsilon=1e-4, **kwargs):
+        super(CompBatchNorm, self).__init__(**kwargs)
+        self.momentum = momentum
+        self.epsilon = epsilon
+
+    def build(self, input_shape):
+        c = int(input_shape[-1]) // 2
+        root = 1.0 / 2 ** 0.5
+        const = tf.keras.initializers.Constant
+        self.gamma_rr = self.add_weight("gamma_rr", shape=(c,), initializer=const(root))
+        self.gamma_ii = self.add_weight("gamma_ii", shape=(c,), initializer=const(root))
+        self.gamma_ri = self.add_weight("gamma_ri", shape=(c,), initializer="zeros")
+        self.beta = self.add_weight("beta", shape=(2, c), initializer="zeros")
+        # Moving statistics are updated per replica and averaged when read, as in Keras BatchNormalization
+        moving = dict(
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.MEAN,
+        )
+        self.moving_mean = self.add_weight("moving_mean", shape=(2, c), initializer="zeros", **moving)
+        self.moving_vrr = self.add_weight("moving_vrr", shape=(c,), initializer=const(root), **moving)
+        self.moving_vii = self.add_weight("moving_vii", shape=(c,), initializer=const(root), **moving)
+        self.moving_vri = self.add_weight("moving_vri", shape=(c,), initializer="zeros", **moving)
+        super(CompBatchNorm, self).build(input_shape)
+
+    def call(self, inputs, training=None):
+        if training is None:
+            training = tf.keras.backend.learning_phase()
+        x = as_pairs(tf.cast(inputs, tf.float32))
+        axes = list(range(len(inputs.shape) - 1))
+
+        def batch_stats():
+            mean = tf.reduce_mean(x, axis=axes)
+            centred = x - mean
+            vrr = tf.reduce_mean(tf.square(centred[..., 0, :]), axis=axes)
+            vii = tf.reduce_mean(tf.square(centred[..., 1, :]), axis=axes)
+            vri = tf.reduce_mean(centred[..., 0, :] * centred[..., 1, :], axis=axes)
+            for var, value in [
+                (self.moving_mean, mean),
+                (self.moving_vrr, vrr),
+                (self.moving_vii, vii),
+                (self.moving_vri, vri),
+            ]:
+                # Updated in float32 and stored in the variable's dtype, float16 in a half precision copy
+                update = self.momentum * tf.cast(var, tf.float32) + (1.0 - self.momentum) * value
+                var.assign(tf.cast(update, var.dtype))
+            return mean, vrr, vii, vri
+
+        # Weights are read in float32 even under mixed precision
+        def moving_stats():
+            return tuple(
+                tf.cast(var, tf.float32)
+                for var in [self.moving_mean, self.moving_vrr, self.moving_vii, self.moving_vri]
+            )
+
+        mean, vrr, vii, vri = tf.cond(tf.cast(training, tf.bool), batch_stats, moving_stats)
+        vrr = vrr + self.epsilon
+        vii = vii + self.epsilon
+
+        # Closed form inverse square root of [[vrr, vri], [vri, vii]]
+        s = tf.sqrt(vrr * vii - vri * vri)
+        t = tf.sqrt(vrr + vii + 2.0 * s)
+        inv = 1.0 / (s * t)
+        wrr = (vii + s) * inv
+        wii = (vrr + s) * inv
+        wri = -vri * inv
+
+        gamma_rr, gamma_ii, gamma_ri, beta = [
+            tf.cast(var, tf.float32) for var in [self.gamma_rr, self.gamma_ii, self.gamma_ri, self.beta]
+        ]
+        centred = x - mean
+        real = wrr * centred[..., 0, :] + wri * centred[..., 1, :]
+        imag = wri * centred[..., 0, :] + wii * centred[..., 1, :]
+        out = tf.stack(
+            [
+                gamma_rr * real + gamma_ri * imag + beta[0],
+                gamma_ri * real + gamma_ii * imag + beta[1],
+            ],
+            axis=-2,
+        )
+        return tf.cast(from_pairs(out), inputs.dtype)
+
+    def get_config(self):
+        config = {"momentum": self.momentum, "epsilon": self.epsilon}
+        base_config = super(CompBatchNorm, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+# Concatenates complex tensors channel-wise, real parts together and imaginary parts together.
+# A plain concatenate of [real | imag] tensors would mix real and imaginary channels.
+class CompConcatenate(layers.Layer):
+    def call(self, inputs):
+        return from_pairs(tf.concat([as_pairs(x) for x in inputs], axis=-1))
+
+
+# Orthonormal 2D FFT of a 2 channel [real | imag] image, returned in the same layout.
+# Always float32, the FFT only takes complex64.
+class FFT2D(layers.Layer):
+    def __init__(self, inverse=False, **kwargs):
+        kwargs.setdefault("dtype", "float32")
+        super(FFT2D, self).__init__(**kwargs)
+        self.inverse = inverse
+
+    def call(self, inputs):
+        x = tf.complex(inputs[..., 0], inputs[..., 1])
+        scale = tf.cast(tf.sqrt(tf.cast(tf.shape(x)[-1] * tf.shape(x)[-2], tf.float32)), tf.complex64)
+        x = tf.signal.ifft2d(x) * scale if self.inverse else tf.signal.fft2d(x) / scale
+        return tf.stack([tf.math.real(x), tf.math.imag(x)], axis=-1)
+
+    def get_config(self):
+        config = {"inverse": self.inverse}
+        base_config = super(FFT2D, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+# Data consistency for 2 channel images. Takes [pred, dec], dec being the model input: the zero-filled image
+# in channels 0 and 1 and the sampling mask (1 where k-space was acquired) in channel 2.
+# Replaces the k-space of pred with the acquired k-space of dec wherever the mask says it was sampled.
+class DataConsistency(layers.Layer):
+    def __init__(self, **kwargs):
+        kwargs.setdefault("dtype", "float32")
+        super(DataConsistency, self).__init__(**kwargs)
+
+    def call(self, inputs):
+        pred, dec = inputs
+        acquired = tf.signal.fft2d(tf.complex(dec[..., 0], dec[..., 1]))
+        kspace = tf.signal.fft2d(tf.complex(pred[..., 0], pred[..., 1]))
+        x = tf.signal.ifft2d(tf.where(dec[..., 2] > 0.5, acquired, kspace))
+        return tf.stack([tf.math.real(x), tf.math.imag(x)], axis=-1)
+
+
+# Image channels of a cascade input, everything but the last (mask) channel. See DataConsistency.
+class ImageChannels(layers.Layer):
+    def __init__(self, **kwargs):
+        kwargs.setdefault("dtype", "float32")
+        super(ImageChannels, self).__init__(**kwargs)
+
+    def call(self, inputs):
+        return inputs[..., :-1]
+
+
+# Complex activation layer by name: "crelu" or "modrelu".
+def comp_activation(name):
+    if name == "modrelu":
+        return ModReLU()
+    if name == "crelu":
+        return CReLU()
+    raise ValueError("unknown complex activation: " + str(name))
+
+
+# Every custom layer of this module, for load_model custom_objects.
+COMPLEX_OBJECTS = {
+    "CompMaxPool2D": CompMaxPool2D,
+    "CompConv2DTranspose": CompConv2DTranspose,
+    "CReLU": CReLU,
+    "ModReLU": ModReLU,
+    "CompBatchNorm": CompBatchNorm,
+    "CompConcatenate": CompConcatenate,
+    "FFT2D": FFT2D,
+    "DataConsistency": DataConsistency,
+    "ImageChannels": ImageChannels,
+}
@@ -0,0 +1,139 @@
+# Data-parallel training. DISTRIBUTE picks the tf.distribute strategy comp_main and real_main build and fit under:
+# none (default), mirrored (MirroredStrategy over REPLICAS logical CPU devices, or every GPU)
+# or multi_worker (MultiWorkerMirroredStrategy, one worker per SLURM task).
+# BATCH_SIZE stays per replica, so the global batch grows with the number of replicas.
+# CONCURRENT trains the comp and real U-Nets at the same time, in separate processes.
+
+import os
+import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import tensorflow as tf
+
+# Strategy of this process, created once by get_strategy
+_strategy = {}
+
+
+# Splits the CPU into n logical devices so MirroredStrategy has CPU replicas.
+# Must run before TF initializes its devices.
+def split_cpu(n):
+    cpu = tf.config.list_physical_devices("CPU")[0]
+    if hasattr(tf.config, "set_logical_device_configuration"):
+        tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * n)
+    else:
+        tf.config.experimental.set_virtual_device_configuration(
+            cpu, [tf.config.experimental.VirtualDeviceConfiguration()] * n
+        )
+    return [device.name for device in tf.config.list_logical_devices("CPU")]
+
+
+# Returns the strategy selected by DISTRIBUTE, creating it on the first call.
+# Scripts should call this first, before any other TF work, so devices and the cluster can still be set up.
+def get_strategy(cfg):
+    if "strategy" in _strategy:
+        return _strategy["strategy"]
+
+    kind = cfg["params"].get("DISTRIBUTE") or "none"
+    if kind == "mirrored":
+        if len(tf.config.list_physical_devices("GPU")) > 0:
+            strategy = tf.distribute.MirroredStrategy()
+        else:
+            replicas = cfg["params"].get("REPLICAS") or 2
+            try:
+                devices = split_cpu(replicas)
+            except RuntimeError:
+                logging.warning("TF already initialized, CPU can't be split into replicas")
+                devices = [device.name for device in tf.config.list_logical_devices("CPU")]
+            strategy = tf.distribute.MirroredStrategy(devices)
+    elif kind == "multi_worker":
+        resolver = None
+        if "SLURM_JOB_ID" in os.environ:
+            resolver = tf.distribute.cluster_resolver.SlurmClusterResolver()
+        if hasattr(tf.distribute, "MultiWorkerMirroredStrategy"):
+            strategy = tf.distribute.MultiWorkerMirroredStrategy(cluster_resolver=resolver)
+        else:
+            strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy(cluster_resolver=resolver)
+    elif kind == "none":
+        strategy = tf.distribute.get_strategy()
+    else:
+        raise ValueError("unknown DISTRIBUTE: " + str(kind))
+
+    logging.info("strategy: " + kind + ", replicas: " + str(strategy.num_replicas_in_sync))
+    _strategy["strategy"] = strategy
+    return strategy
+
+
+# Returns (number of workers, index of this worker) of a strategy, (1, 0) when not multi-worker.
+def worker_shard(strategy):
+    resolver = getattr(strategy, "cluster_resolver", None)
+    if resolver is None or not resolver.cluster_spec().as_dict():
+        return 1, 0
+    workers = len(resolver.cluster_spec().as_dict().get("worker", []))
+    return max(workers, 1), resolver.task_id or 0
+
+
+# Returns True on the worker that should write models and logs, the chief (worker 0).
+def is_chief(strategy):
+    return worker_shard(strategy)[1] == 0
+
+
+# Returns the output path of an addrs key. Workers other than the chief write to their own copy.
+def out_path(cfg, ADDR, key, strategy):
+    _, index = worker_shard(strategy)
+    if index == 0:
+        return ADDR / cfg["addrs"][key]
+    return ADDR / (str(cfg["addrs"][key]) + "_worker%d" % index)
+
+
+# Worker process for CONCURRENT training. Memory-maps the data the parent loaded (see train_concurrently)
+# and trains one U-Net.
+def train_one(kind, cfg, ADDR, data, threads):
+    from unet_compare.comp_unet import comp_main
+    from unet_compare.real_unet import real_main
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    get_strategy(cfg)
+
+    mask = np.load(data["mask"])
+    stats = np.load(data["stats"])
+    rec_train = np.load(data["rec_train"], mmap_mode="r")
+    dec_val = np.load(data["dec_val"], mmap_mode="r")
+    rec_val = np.load(data["rec_val"], mmap_mode="r")
+    main = comp_main if kind == "comp" else real_main
+    main(cfg, ADDR, mask, stats, rec_train, dec_val, rec_val)
+
+    return kind
+
+
+# Trains the comp and real U-Nets at the same time in two spawned processes, splitting the CPU cores between them.
+# The data is loaded once here and written as .npy files both workers memory-map read-only, as in sweep.py.
+# cfg must be picklable, e.g. a plain dict from OmegaConf.to_container.
+def train_concurrently(cfg, ADDR):
+    from unet_compare.functions import get_brains
+    from unet_compare.evaluate import shared_array
+
+    threads = max(1, os.cpu_count() // 2)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mask, stats, dec_train, rec_train, dec_val, rec_val = get_brains(cfg, ADDR)
+        data = {
+            "rec_train": shared_array(rec_train, "rec_train", tmp_dir),
+            "dec_val": shared_array(dec_val, "dec_val", tmp_dir),
+            "rec_val": shared_array(rec_val, "rec_val", tmp_dir),
+            "mask": os.path.join(tmp_dir, "mask.npy"),
+            "stats": os.path.join(tmp_dir, "stats.npy"),
+        }
+        np.save(data["mask"], mask)
+        np.save(data["stats"], stats)
+        del mask, stats, dec_train, rec_train, dec_val, rec_val
+
+        # Spawned workers, TF does not survive a fork once it is initialized
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=2, mp_context=context) as pool:
+            futures = [pool.submit(train_one, kind, cfg, ADDR, data, threads) for kind in ["comp", "real"]]
+            for future in futures:
+                logging.info(future.result() + " UNet trained")
+
+    return
@@ -0,0 +1,209 @@
+# Headless evaluation of trained model pairs, spread across a process pool.
+# The test set is written once as .npy (or reused from the data cache) and memory-mapped read-only by every worker.
+# Per model metrics are merged into the metrics text file plus one JSON and one CSV report.
+
+import os
+import re
+import csv
+import glob
+import json
+import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import tensorflow as tf
+from unet_compare.functions import CUSTOM_OBJECTS, model_inputs
+from unet_compare.batch_metrics import batch_metrics
+
+# Columns of the CSV report, also the keys of each JSON entry
+REPORT_FIELDS = [
+    "kind",
+    "model",
+    "log",
+    "ssim_mean",
+    "ssim_std",
+    "nrmse_mean",
+    "nrmse_std",
+    "psnr_mean",
+    "psnr_std",
+    "epoch",
+    "val_loss",
+]
+
+
+# Reads a CSVLogger file, returns the epoch and value of the lowest val_loss.
+def convergence(log_path):
+
+    with open(log_path, "r") as log:
+        rows = [line.strip().split("|") for line in log if line.strip()]
+
+    epoch_col = rows[0].index("epoch")
+    loss_col = rows[0].index("val_loss")
+    best = min(rows[1:], key=lambda row: float(row[loss_col]))
+
+    return float(best[epoch_col]), float(best[loss_col])
+
+
+# Matches an addrs glob, returns {wildcard values: path}. Paths of two globs with the same wildcard values belong
+# together, e.g. a model and its training log in the same run directory.
+def glob_matches(ADDR, pattern):
+
+    pattern = str(ADDR / pattern)
+    regex = "".join(
+        "([^/]*)" if c == "*" else "([^/])" if c == "?" else re.escape(c) for c in pattern
+    )
+    matches = {}
+    for path in glob.glob(pattern):
+        match = re.fullmatch(regex, path)
+        if match is not None:
+            matches[match.groups()] = path
+
+    return matches
+
+
+# Returns (model, log) pairs of one kind, paired by wildcard values. Raises if a model has no log.
+def model_logs(ADDR, model_pattern, log_pattern):
+
+    models = glob_matches(ADDR, model_pattern)
+    logs = glob_matches(ADDR, log_pattern)
+    missing = [models[key] for key in sorted(models) if key not in logs]
+    if missing:
+        raise FileNotFoundError("no training log matching " + str(log_pattern) + " for: " + ", ".join(missing))
+
+    return [(models[key], logs[key]) for key in sorted(models)]
+
+
+# Returns a path that workers can memory-map an array from, writing the array to tmp_dir if needed.
+def shared_array(array, name, tmp_dir):
+
+    # Arrays already memory-mapped whole from a .npy file (e.g. from the data cache) are used in place
+    if isinstance(array, np.memmap) and str(array.filename).endswith(".npy"):
+        if np.load(array.filename, mmap_mode="r").shape == array.shape:
+            return array.filename
+
+    path = os.path.join(tmp_dir, name + ".npy")
+    np.save(path, np.asarray(array, dtype=np.float32))
+    return path
+
+
+# Worker. Loads one model, predicts on the memory-mapped test set, returns its metrics.
+def evaluate_model(kind, model_path, log_path, dec_path, rec_path, chunk, batch_size, threads):
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    dec_test = np.load(dec_path, mmap_mode="r")
+    rec_test = np.load(rec_path, mmap_mode="r")
+
+    model = tf.keras.models.load_model(
+        model_path, custom_objects=CUSTOM_OBJECTS
+    )
+    pred = model.predict(model_inputs(model, dec_test), batch_size=batch_size, verbose=0)
+    pred = pred / np.max(np.abs(pred[:, :, :, 0] + 1j * pred[:, :, :, 1]))
+
+    result = batch_metrics(rec_test, pred, chunk)
+    epoch, val_loss = convergence(log_path)
+
+    return {
+        "kind": kind,
+        "model": str(model_path),
+        "log": str(log_path),
+        "ssim": result.ssim,
+        "nrmse": result.nrmse * 100,
+        "psnr": result.psnr,
+        "epoch": epoch,
+        "val_loss": val_loss,
+    }
+
+
+# Writes per model and averaged metrics to the metrics text file, and the JSON and CSV reports.
+def write_reports(cfg, ADDR, results):
+
+    rows = []
+    for res in results:
+        row = {"kind": res["kind"], "model": res["model"], "log": res["log"]}
+        for name in ["ssim", "nrmse", "psnr"]:
+            row[name + "_mean"] = float(res[name].mean())
+            row[name + "_std"] = float(res[name].std())
+        row["epoch"] = res["epoch"]
+        row["val_loss"] = res["val_loss"]
+        rows.append(row)
+
+    metrics_path = ADDR / cfg["addrs"]["METRICS"]
+    base = os.path.splitext(str(metrics_path))[0]
+
+    with open(metrics_path, "w") as metrics_file:
+        metrics_file.write("Metrics:\n")
+        for row in rows:
+            metrics_file.write("\n\n" + ("Complex: " if row["kind"] == "comp" else "Real: "))
+            metrics_file.write(row["model"])
+            metrics_file.write("\nSSIM: %.3f +/- %.3f" % (row["ssim_mean"], row["ssim_std"]))
+            metrics_file.write("\nNRMSE: %.3f +/- %.3f" % (row["nrmse_mean"], row["nrmse_std"]))
+            metrics_file.write("\nPSNR: %.3f +/- %.3f" % (row["psnr_mean"], row["psnr_std"]))
+            metrics_file.write("\nEpochs: %.3f" % (row["epoch"]))
+
+        # Averages are over every slice of every model of a kind
+        averages = {}
+        for kind, title in [("comp", "Comp avgs: "), ("real", "Real avgs: ")]:
+            kind_results = [res for res in results if res["kind"] == kind]
+            if len(kind_results) == 0:
+                continue
+            avg = {}
+            for name in ["ssim", "nrmse", "psnr"]:
+                values = np.concatenate([res[name] for res in kind_results])
+                avg[name + "_mean"] = float(values.mean())
+                avg[name + "_std"] = float(values.std())
+            epochs = np.asarray([res["epoch"] for res in kind_results])
+            avg["epoch_mean"] = float(epochs.mean())
+            avg["epoch_std"] = float(epochs.std())
+            averages[kind] = avg
+
+            metrics_file.write("\n\n" + title)
+            metrics_file.write("\nSSIM: %.3f +/- %.3f" % (avg["ssim_mean"], avg["ssim_std"]))
+            metrics_file.write("\nNRMSE: %.3f +/- %.3f" % (avg["nrmse_mean"], avg["nrmse_std"]))
+            metrics_file.write("\nPSNR: %.3f +/- %.3f" % (avg["psnr_mean"], avg["psnr_std"]))
+            metrics_file.write("\nEpochs: %.3f +/- %.3f" % (avg["epoch_mean"], avg["epoch_std"]))
+
+    with open(base + ".json", "w") as json_file:
+        json.dump({"models": rows, "averages": averages}, json_file, indent=2)
+
+    with open(base + ".csv", "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    logging.info("metrics written to: " + base + ".json")
+
+    return rows
+
+
+# Evaluates every model matched by COMP_ARC/REAL_ARC, one model per worker process.
+def evaluate_models(cfg, ADDR, dec_test, rec_test):
+
+    # Each model is paired with the training log its wildcards match, e.g. from its own directory
+    jobs = [("comp", m, l) for m, l in model_logs(ADDR, cfg["addrs"]["COMP_ARC"], cfg["addrs"]["COMP_LOG"])]
+    jobs += [("real", m, l) for m, l in model_logs(ADDR, cfg["addrs"]["REAL_ARC"], cfg["addrs"]["REAL_LOG"])]
+    logging.info("models to evaluate: " + str(len(jobs)))
+
+    workers = min(cfg["params"].get("WORKERS") or os.cpu_count(), max(len(jobs), 1))
+    threads = max(1, os.cpu_count() // workers)
+    chunk = cfg["params"].get("METRICS_CHUNK")
+    batch_size = cfg["params"].get("BATCH_SIZE", 16)
+
+    with tempfile.TemporaryDirectory(dir=str(ADDR)) as tmp_dir:
+        dec_path = shared_array(dec_test, "dec_test", tmp_dir)
+        rec_path = shared_array(rec_test, "rec_test", tmp_dir)
+
+        # Spawned workers, TF does not survive a fork once it is initialized
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = [
+                pool.submit(
+                    evaluate_model, kind, model, log, dec_path, rec_path, chunk, batch_size, threads
+                )
+                for kind, model, log in jobs
+            ]
+            results = [future.result() for future in futures]
+
+    return write_reports(cfg, ADDR, results)
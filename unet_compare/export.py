@@ -0,0 +1,208 @@
+# Inference-only export of trained models. The weights are frozen into constants, so weight-only work such as
+# the fused CompConv2D kernel concatenation folds away, and the graph is saved as a SavedModel with a fixed
+# (batch, H, W, channels) float32 signature, optionally XLA-compiled. Loading it needs neither Keras nor custom_objects.
+# An optional TFLite variant is written with float16 or int8 weights (see quantize.py for calibrated int8).
+# Every export is checked against the original model and timed, cold start and per-slice latency.
+
+import os
+import json
+import time
+import logging
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+from unet_compare.functions import CUSTOM_OBJECTS, model_inputs
+
+# Written next to every export, marks a directory as one and records how it was made
+EXPORT_INFO = "export.json"
+
+
+# tf.function with XLA on or off. jit_compile was experimental_compile before TF 2.5.
+def compiled(fn, signature, xla):
+    try:
+        return tf.function(fn, input_signature=signature, jit_compile=xla)
+    except TypeError:
+        return tf.function(fn, input_signature=signature, experimental_compile=xla)
+
+
+# Input signature of a model, batch None for any batch size.
+def model_signature(model, batch=None):
+    return [tf.TensorSpec((batch,) + tuple(model.input_shape[1:]), tf.float32, name="dec")]
+
+
+# Returns the inference function of a model with its variables frozen into constants.
+def freeze(model, batch=None):
+    concrete = tf.function(lambda dec: model(dec, training=False)).get_concrete_function(
+        *model_signature(model, batch)
+    )
+    return convert_variables_to_constants_v2(concrete)
+
+
+# Writes a frozen, optionally XLA-compiled SavedModel of model to path, with a serving_default signature.
+def export_savedmodel(model, path, xla=True):
+    frozen = freeze(model)
+    module = tf.Module()
+    module.serve = compiled(
+        lambda dec: {"rec": tf.nest.flatten(frozen(dec))[0]}, model_signature(model), xla
+    )
+    tf.saved_model.save(module, str(path), signatures={"serving_default": module.serve.get_concrete_function()})
+    return path
+
+
+# Writes a TFLite model of model to path. quantize is None (float32), "float16" or "int8".
+# int8 quantizes weights only (dynamic range), unless calibration slices are given: then activations are
+# quantized too, with ranges calibrated on them, and ops without int8 kernels fall back to float.
+# Inputs and outputs stay float32 either way.
+# TFLite needs a fixed batch, so the model takes one slice at a time. Ops TFLite lacks, such as FFTs, run as TF ops.
+def export_tflite(model, path, quantize=None, calibration=None):
+    concrete = tf.function(lambda dec: model(dec, training=False)).get_concrete_function(
+        *model_signature(model, 1)
+    )
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete])
+    converter.target_spec.supported_ops = [
+        tf.lite.OpsSet.TFLITE_BUILTINS,
+        tf.lite.OpsSet.SELECT_TF_OPS,
+    ]
+    if quantize is not None:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantize == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == "int8" and calibration is not None:
+        converter.representative_dataset = lambda: (
+            [np.asarray(image[None], dtype=np.float32)] for image in calibration
+        )
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+            tf.lite.OpsSet.TFLITE_BUILTINS,
+            tf.lite.OpsSet.SELECT_TF_OPS,
+        ]
+    elif quantize not in [None, "int8"]:
+        raise ValueError("unknown TFLite quantization: " + str(quantize))
+
+    with open(str(path), "wb") as f:
+        f.write(converter.convert())
+    return path
+
+
+# An exported SavedModel behind the predict_on_batch/predict calls the scripts use on Keras models.
+class ExportedModel:
+    def __init__(self, path):
+        self.loaded = tf.saved_model.load(str(path))
+        self.serve = self.loaded.signatures["serving_default"]
+
+    def predict_on_batch(self, x):
+        return self.serve(dec=tf.convert_to_tensor(np.asarray(x, dtype=np.float32)))["rec"].numpy()
+
+    def predict(self, x, batch_size=16, verbose=0):
+        return np.concatenate(
+            [self.predict_on_batch(x[start:start + batch_size]) for start in range(0, len(x), batch_size)]
+        )
+
+
+# A TFLite model behind the same calls, run one slice at a time.
+# threads is the interpreter's CPU threads, None for its default.
+class TFLiteModel:
+    def __init__(self, path, threads=None):
+        try:
+            self.interpreter = tf.lite.Interpreter(model_path=str(path), num_threads=threads)
+        except TypeError:
+            self.interpreter = tf.lite.Interpreter(model_path=str(path))
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]["index"]
+        self.output = self.interpreter.get_output_details()[0]["index"]
+
+    def predict_on_batch(self, x):
+        out = []
+        for image in np.asarray(x, dtype=np.float32):
+            self.interpreter.set_tensor(self.input, image[None])
+            self.interpreter.invoke()
+            out.append(self.interpreter.get_tensor(self.output)[0])
+        return np.stack(out)
+
+    def predict(self, x, batch_size=16, verbose=0):
+        return self.predict_on_batch(x)
+
+
+# Loads a model for inference: an export directory as an ExportedModel, a .tflite file as a TFLiteModel,
+# anything else as a Keras model. threads is the TFLite interpreter's CPU threads.
+def load_inference_model(path, threads=None):
+    if os.path.exists(os.path.join(str(path), EXPORT_INFO)):
+        return ExportedModel(path)
+    if str(path).endswith(".tflite"):
+        return TFLiteModel(path, threads)
+    return tf.keras.models.load_model(str(path), custom_objects=CUSTOM_OBJECTS)
+
+
+# Agreement of an export with the reference outputs: max abs difference and NRMSE relative to the reference.
+def parity(ref, pred):
+    return {
+        "max_abs_diff": float(np.max(np.abs(pred - ref))),
+        "nrmse": float(np.sqrt(np.mean((pred - ref) ** 2)) / max(np.sqrt(np.mean(ref ** 2)), 1e-12)),
+    }
+
+
+# Cold start (load and first slice) and median per-slice latency at batch 1 and at batch_size, in ms.
+def latency(path, dec, batch_size, repeats, threads=None):
+    start = time.perf_counter()
+    model = load_inference_model(path, threads)
+    model.predict_on_batch(dec[:1])
+    result = {"cold_start_ms": (time.perf_counter() - start) * 1e3}
+
+    for name, batch in [("slice_ms_batch_1", dec[:1]), ("slice_ms_batch_%d" % batch_size, dec[:batch_size])]:
+        model.predict_on_batch(batch)
+        times = np.zeros(repeats)
+        for ii in range(repeats):
+            start = time.perf_counter()
+            model.predict_on_batch(batch)
+            times[ii] = time.perf_counter() - start
+        result[name] = float(np.median(times)) * 1e3 / len(batch)
+
+    return model, result
+
+
+# Total size of a file or directory in MB.
+def size_mb(path):
+    if os.path.isfile(str(path)):
+        return os.path.getsize(str(path)) / 2 ** 20
+    return sum(
+        os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(str(path)) for name in names
+    ) / 2 ** 20
+
+
+# Exports the Keras model at model_path into out_dir (savedmodel/ and, with tflite, model.tflite),
+# checks each export against the original on dec and writes the parity and latency report to out_dir/report.json.
+def export_model(model_path, out_dir, dec, xla=True, tflite=None, batch_size=16, repeats=20):
+    os.makedirs(str(out_dir), exist_ok=True)
+    model = tf.keras.models.load_model(str(model_path), custom_objects=CUSTOM_OBJECTS)
+    dec = model_inputs(model, dec)
+
+    saved_path = os.path.join(str(out_dir), "savedmodel")
+    export_savedmodel(model, saved_path, xla)
+    with open(os.path.join(saved_path, EXPORT_INFO), "w") as f:
+        json.dump({"source": str(model_path), "xla": xla, "input_shape": list(model.input_shape[1:])}, f, indent=2)
+
+    exports = [("keras", str(model_path)), ("savedmodel", saved_path)]
+    if tflite is not None:
+        tflite_path = os.path.join(str(out_dir), "model.tflite")
+        export_tflite(model, tflite_path, None if tflite == "float32" else tflite)
+        exports.append(("tflite_" + tflite, tflite_path))
+
+    report = {}
+    ref = None
+    for name, path in exports:
+        loaded, result = latency(path, dec, batch_size, repeats)
+        pred = loaded.predict(dec, batch_size=batch_size)
+        if ref is None:
+            ref = pred
+        result.update(parity(ref, pred))
+        result["size_mb"] = size_mb(path)
+        report[name] = result
+        logging.info(
+            "%s: cold start %.0f ms, %.2f ms/slice at batch 1, max abs diff %.2e, %.1f MB"
+            % (name, result["cold_start_ms"], result["slice_ms_batch_1"], result["max_abs_diff"], result["size_mb"])
+        )
+
+    with open(os.path.join(str(out_dir), "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    return report
@@ -2,36 +2,48 @@
 # This is the majority of code for this project.
 # Because of this, commenting is only done at function top. Good luck.
 
-# Note that the get_test and get_brains functions load all data, even if they only return a part.
-# This is a flaw that could be fixed.
+# Note that the get_test and get_brains functions only read the slices they return.
+# File headers are used to size buffers, and slices are read through memory-mapped .npy access.
+# A TRAIN/VAL/TEST address can also be a shard directory written by make_shards.py (see shards.py).
 
 import os
+import copy
+import functools
 from re import L
 import tensorflow as tf
 from tensorflow.keras import layers
 from tensorflow.keras.layers import Input, Conv2D, MaxPooling2D, concatenate, UpSampling2D
 import numpy as np
-import glob
 from tensorflow.keras import backend as K
 from tensorflow.keras.models import Model
 import logging
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
-import random
+import zlib
 import sigpy.mri as sp
-from skimage.metrics import structural_similarity as ssim
-from skimage.metrics import normalized_root_mse as norm_root_mse
-from skimage.metrics import peak_signal_noise_ratio as psnr
 import matplotlib.pyplot as plt
+from unet_compare.cache import cached_slices
+from unet_compare.shards import open_store
+from unet_compare.batch_metrics import batch_metrics
+from unet_compare.profiling import timed, timed_batches, peak_rss
+from unet_compare.complex_layers import (
+    CompMaxPool2D,
+    CompConv2DTranspose,
+    CompBatchNorm,
+    CompConcatenate,
+    comp_activation,
+    FFT2D,
+    DataConsistency,
+    ImageChannels,
+    COMPLEX_OBJECTS,
+)
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
-# Compares two data sets, prints and returns ssim, psnr, nrmse.
-def metrics(ref, pred):
+# Compares two data sets, prints and returns ssim, nrmse, psnr (one row per slice).
+# Metrics for the whole set are computed at once by batch_metrics, chunk bounds memory use.
+def metrics(ref, pred, chunk=None):
 
-    for ii in range(pred.shape[0]):  
-        metrics[ii,0] = ssim(ref[ii].ravel(), pred[ii].ravel(), win_size = ref[ii].size-1)
-        metrics[ii,1] = norm_root_mse(ref[ii], pred[ii])
-        metrics[ii,2] = psnr(ref[ii], pred[ii], data_range=(ref[ii].max()-ref[ii].min())) 
+    result = batch_metrics(ref, pred, chunk)
+    metrics = np.stack([result.ssim, result.nrmse, result.psnr], axis=1)
 
     metrics[:,1] = metrics[:,1]*100
     print("Metrics:")
@@ -41,57 +53,185 @@ def metrics(ref, pred):
 
     return metrics
 
+# Returns the (H, W) slice shape of the dataset, read from the first scan files or shard index found.
+def scan_shape(cfg, ADDR):
+
+    for key in ["TRAIN", "VAL", "TEST"]:
+        if cfg["addrs"].get(key) is None:
+            continue
+        store = open_store(ADDR, cfg["addrs"][key])
+        if len(store.paths) > 0:
+            return tuple(store.slice_shape[:2])
+
+    raise FileNotFoundError("no scan files found to read the slice shape from")
+
+# Loads the first NUM_MASKS masks of the mask bank into one boolean array, in one read.
+def load_masks(cfg, ADDR, shape):
+
+    num = cfg["params"]["NUM_MASKS"]
+    with np.load(str(mask_bank_path(ADDR, cfg, shape))) as bank:
+        bits = bank["bits"][:num]
+    mask = np.unpackbits(bits, axis=1, count=shape[0] * shape[1]).reshape(num, shape[0], shape[1])
+    mask = mask.astype(bool)
+    logging.info("masks: " + str(len(mask)))
+
+    return mask
+
+# Returns the random state used to load one split.
+# With a SEED each split gets its own stream, so a split loads the same whether or not the others were cached.
+def split_rng(cfg, name):
+
+    if cfg["params"].get("SEED") is None:
+        return np.random
+
+    return np.random.RandomState([cfg["params"]["SEED"], zlib.crc32(name.encode())])
+
+# Returns True when the undersampled model inputs carry their sampling mask as a third channel,
+# 1 where k-space was acquired. Cascades need it for their data consistency steps.
+def mask_input(cfg):
+
+    return bool(cfg["params"].get("CASCADE"))
+
+# Returns the channels of dec a model takes, so plain U-Nets can run on inputs loaded with a mask channel.
+def model_inputs(model, dec):
+
+    channels = model.input_shape[-1]
+    if channels > dec.shape[-1]:
+        raise ValueError("model takes the sampling mask as an input channel, set CASCADE to load it")
+    if channels == dec.shape[-1]:
+        return dec
+    return dec[:, :, :, :channels]
+
+# Streams of the counter-based RNG, one per kind of random draw.
+SHUFFLE_STREAM = 0
+MASK_STREAM = 1
+AUG_STREAM = 2
+
+# Returns the seed of the training pipelines, SEED or 905 if unset.
+def data_seed(cfg):
+
+    seed = cfg["params"].get("SEED")
+    return 905 if seed is None else seed
+
+# Counter-based seeds, (N, 2) seeds for the tf.random.stateless ops, a pure function of (seed, epoch, index, stream).
+# Any process, worker or cache fill gets the same draw for a sample, whatever order samples are visited in.
+# Both training pipelines draw from these, data_aug eagerly and data_pipeline in graph, so they see the same data.
+def stateless_seeds(seed, epochs, indexes, stream):
+
+    epochs = tf.cast(epochs, tf.int64)
+    indexes = tf.cast(indexes, tf.int64)
+    first = tf.fill(tf.shape(indexes), tf.constant(seed * 3 + stream, tf.int64))
+    return tf.stack([first, epochs * 2 ** 32 + indexes], axis=1)
+
+# Shuffled order of the n training samples in one epoch, int64.
+def epoch_order(seed, epoch, n):
+
+    shuffle = stateless_seeds(seed, [epoch], [0], SHUFFLE_STREAM)[0]
+    return tf.cast(tf.argsort(tf.random.stateless_uniform([n], shuffle)), tf.int64)
+
+# Mask index of each sample in indexes, drawn in epochs (one per index).
+def sample_masks(seed, epochs, indexes, num_masks):
+
+    return tf.map_fn(
+        lambda s: tf.random.stateless_uniform([], s, 0, num_masks, dtype=tf.int32),
+        stateless_seeds(seed, epochs, indexes, MASK_STREAM),
+        dtype=tf.int32,
+    )
+
+# Draws num random slices from a SliceStore (scan files or shards) and returns them undersampled and complete.
+# Slices are drawn before any pixel data is read, then only the shards holding them are read, in parallel.
+# Returned slices are in random order. Each slice gets its own mask, drawn with the slices before reading.
+# Results go straight into preallocated dtype buffers, with_dec=False skips the undersampled set (dec is None).
+# with_mask adds each slice's sampling mask to dec as a third channel, see mask_input.
+def load_slices(store, num, mask, cfg, shape, rng=np.random, dtype=np.float64, with_dec=True, with_mask=False):
+
+    norm = np.sqrt(shape[0] * shape[1])
+
+    indexes = rng.permutation(len(store))[:num]
+    masks = rng.randint(0, cfg["params"]["NUM_MASKS"], len(indexes))
+
+    rec = np.zeros((len(indexes), shape[0], shape[1], 2), dtype=dtype)
+    channels = 3 if with_mask else 2
+    dec = np.zeros((len(indexes), shape[0], shape[1], channels), dtype=dtype) if with_dec else None
+    for pos, kspace in store.chunks(indexes):
+        kspace = (kspace[:, :, :, 0] + 1j * kspace[:, :, :, 1]) / norm
+        rec2 = np.fft.ifft2(kspace)
+        rec[pos, :, :, 0] = rec2.real
+        rec[pos, :, :, 1] = rec2.imag
+        del rec2
+        if with_dec:
+            keep = ~mask[masks[pos]]
+            dec2 = np.fft.ifft2(kspace * keep)
+            dec[pos, :, :, 0] = dec2.real
+            dec[pos, :, :, 1] = dec2.imag
+            if with_mask:
+                dec[pos, :, :, 2] = keep
+
+    return dec, rec
+
+# Divides a (N, H, W, 2) stack in place by its max complex magnitude, a chunk at a time.
+# Only the image channels are scaled, a mask channel (see mask_input) is left as it is.
+def normalize(x, chunk=256):
+
+    peak = 0.0
+    for start in range(0, len(x), chunk):
+        part = x[start:start + chunk]
+        peak = max(peak, float(np.sqrt((part[:, :, :, 0] ** 2 + part[:, :, :, 1] ** 2).max())))
+    # An all zero stack is left as it is rather than divided by zero
+    if peak == 0:
+        logging.warning("normalize: all slices are zero, left unscaled")
+        return x
+    for start in range(0, len(x), chunk):
+        x[start:start + chunk, :, :, :2] /= peak
+
+    return x
+
+# Mean and std of the complex magnitude of a (N, H, W, 2) stack, a chunk at a time.
+def magnitude_stats(x, chunk=256):
+
+    total = 0.0
+    squares = 0.0
+    for start in range(0, len(x), chunk):
+        part = x[start:start + chunk].astype(np.float64)
+        squares += float((part[:, :, :, 0] ** 2 + part[:, :, :, 1] ** 2).sum())
+        total += float(np.sqrt(part[:, :, :, 0] ** 2 + part[:, :, :, 1] ** 2).sum())
+    count = x.shape[0] * x.shape[1] * x.shape[2]
+    mean = total / count
+
+    return mean, np.sqrt(max(squares / count - mean ** 2, 0.0))
+
 # Gets test data only.
+@timed("get_test")
 def get_test(cfg, ADDR):
 
-    dec_files_test = np.asarray(glob.glob(str(ADDR / cfg["addrs"]["TEST"])))
+    store_test = open_store(ADDR, cfg["addrs"]["TEST"], cfg["params"].get("READ_WORKERS", 4))
 
-    logging.info("test scans: " + str(len(dec_files_test)))
+    logging.info("test scans: " + str(len(store_test.paths)) + ", slices: " + str(len(store_test)))
     logging.debug("Scans loaded")
 
-    shape = (256, 256)
-    norm = np.sqrt(shape[0] * shape[1])
+    shape = tuple(store_test.slice_shape[:2])
+    logging.info("slice shape: " + str(shape))
 
-    mask = np.zeros((cfg["params"]["NUM_MASKS"], shape[0], shape[1]))
-    masks = np.asarray(glob.glob(str(ADDR / cfg["addrs"]["MASKS"])))
-    for i in range(len(masks)):
-        mask[i] = np.load(masks[i])
-    mask = mask.astype(bool)
-    logging.info("masks: " + str(len(mask)))
+    mask = load_masks(cfg, ADDR, shape)
 
-    ntest = 0
-    for ii in range(len(dec_files_test)):
-        ntest += np.load(dec_files_test[ii]).shape[0]
-
-    rec_test = np.zeros((ntest, shape[0], shape[1], 2))
-    dec_test = np.zeros((ntest, shape[0], shape[1], 2))
-    aux_counter = 0
-    for ii in range(len(dec_files_test)):
-        dec1 = np.load(dec_files_test[ii]) / norm
-        rec1 = np.copy(dec1)
-        dec1[:, mask[int(random.randint(0, cfg["params"]["NUM_MASKS"] - 1))], :] = 0
-        dec2 = np.fft.ifft2(dec1[:, :, :, 0] + 1j * dec1[:, :, :, 1])
-        rec2 = np.fft.ifft2(rec1[:, :, :, 0] + 1j * rec1[:, :, :, 1])
-        aux = rec1.shape[0]
-        dec_test[aux_counter : aux_counter + aux, :, :, 0] = dec2.real
-        dec_test[aux_counter : aux_counter + aux, :, :, 1] = dec2.imag
-        rec_test[aux_counter : aux_counter + aux, :, :, 0] = rec2.real
-        rec_test[aux_counter : aux_counter + aux, :, :, 1] = rec2.imag
-        aux_counter += aux
-    
-    indexes = np.arange(rec_test.shape[0], dtype=int)
-    np.random.shuffle(indexes)
-    rec_test = rec_test[indexes]
-    dec_test = dec_test[indexes]
+    def build_test():
+        dec_test, rec_test = load_slices(
+            store_test,
+            cfg["params"]["NUM_TEST"],
+            mask,
+            cfg,
+            shape,
+            split_rng(cfg, "test"),
+            dtype=np.float32 if cfg["params"].get("LEAN_LOAD", False) else np.float64,
+            with_mask=mask_input(cfg),
+        )
 
-    dec_test = dec_test[: cfg["params"]["NUM_TEST"], :, :, :]
-    rec_test = rec_test[: cfg["params"]["NUM_TEST"], :, :, :]
+        dec_test = normalize(dec_test).astype('float32', copy=False)
+        rec_test = normalize(rec_test).astype('float32', copy=False)
 
-    dec_test = dec_test / np.max(np.abs(dec_test[:, :, :, 0] + 1j * dec_test[:, :, :, 1]))
-    rec_test = rec_test / np.max(np.abs(rec_test[:, :, :, 0] + 1j * rec_test[:, :, :, 1]))
+        return dec_test, rec_test
 
-    dec_test = dec_test.astype('float32')
-    rec_test = rec_test.astype('float32')
+    dec_test, rec_test = cached_slices(cfg, ADDR, "test", store_test.files, mask, build_test)
 
     logging.info("dec test: " + str(dec_test.shape))
     logging.info("rec test: " + str(rec_test.shape))
@@ -116,230 +256,344 @@ def create_circular_mask(h=256, w=256, center=None, radius=16):
 
     mask = dist_from_center <= radius
     mask = ~np.fft.fftshift(mask, axes=(0, 1))
-    mask = mask.astype(np.bool)
+    mask = mask.astype(bool)
     
     return mask
 
-# Creates a number of masks with a poisson disk and a circular mask
-def mask_gen(ADDR, cfg):
+# Returns the mask bank file for a shape, ACCEL, SEED and circle radius.
+# One bank holds every mask for those parameters as a packed bit array.
+def mask_bank_path(ADDR, cfg, shape=(256, 256)):
 
-    files = np.asarray(glob.glob(str(ADDR / cfg["addrs"]["MASKS"])))
-    for f in files:
-        os.remove(f)
+    name = "bank_%dx%d_accel%s_seed%s_radius%s.npz" % (
+        shape[0],
+        shape[1],
+        cfg["params"]["ACCEL"],
+        cfg["params"].get("SEED") or 0,
+        cfg["params"].get("MASK_RADIUS", 16),
+    )
 
-    for k in range(cfg["params"]["NUM_MASKS"]):
-        mask = sp.poisson(
-            img_shape=(256, 256),
-            accel=cfg["params"]["ACCEL"],
-            dtype=int,
-            crop_corner=False,
-        )
+    return ADDR / cfg["addrs"]["MASK_SAVE"] / name
 
-        mask = ~np.fft.fftshift(mask, axes=(0, 1))
+# Creates one mask with a poisson disk and a circular mask.
+def poisson_mask(shape, accel, seed, circle):
 
-        mask = mask + 2
-        mask = mask.astype(np.bool)
-        mask = mask & create_circular_mask()
+    mask = sp.poisson(
+        img_shape=shape,
+        accel=accel,
+        dtype=int,
+        crop_corner=False,
+        seed=seed,
+    )
 
-        sampling = (1.0*mask.sum()/mask.size) * 100
+    mask = ~np.fft.fftshift(mask, axes=(0, 1))
 
-        filename = "/mask" + str(int(k)) + "_" + str(cfg["params"]["ACCEL"]) + "_" + str(int(sampling)) + ".npy"
-        filename = cfg["addrs"]["MASK_SAVE"] + filename
-        np.save(
-            str(ADDR / filename),
-            mask,
-        )
+    mask = mask + 2
+    mask = mask.astype(bool)
+    mask = mask & circle
 
-    return
+    return mask
 
+# Creates a bank of NUM_MASKS masks of the data's slice shape, unless a bank with the same parameters and enough masks exists.
+# Mask k uses seed SEED + k. Masks are generated serially: a worker process would have to import TF with the
+# package, which costs more than the masks, and the bank is only built once.
+@timed("mask_gen")
+def mask_gen(ADDR, cfg, shape=None):
 
-# Returns an image generator which generates images, undersampled and complete
-def data_aug(rec_train, mask, stats, cfg):
-    seed = 905
-    rec_datagen1 = ImageDataGenerator(
-        rotation_range=40,
-        width_shift_range=0.075,
-        height_shift_range=0.075,
-        shear_range=0.25,
-        zoom_range=0.25,
-        horizontal_flip=False,
-        vertical_flip=False,
-        fill_mode="nearest",
-    )
+    if shape is None:
+        shape = scan_shape(cfg, ADDR)
+    path = mask_bank_path(ADDR, cfg, shape)
+    num = cfg["params"]["NUM_MASKS"]
 
-    rec_datagen2 = ImageDataGenerator(
-        rotation_range=40,
-        width_shift_range=0.075,
-        height_shift_range=0.075,
-        shear_range=0.25,
-        zoom_range=0.25,
-        horizontal_flip=False,
-        vertical_flip=False,
-        fill_mode="nearest",
-    )
+    if path.exists():
+        with np.load(str(path)) as bank:
+            if int(bank["count"]) >= num:
+                logging.info("mask bank reused: " + str(path))
+                return
 
-    rec_datagen1.fit(rec_train[:, :, :, 0, np.newaxis], augment=True, seed=seed)
-    rec_datagen2.fit(rec_train[:, :, :, 1, np.newaxis], augment=True, seed=seed)
+    seed = cfg["params"].get("SEED") or 0
+    circle = create_circular_mask(shape[0], shape[1], radius=cfg["params"].get("MASK_RADIUS", 16))
 
-    rec_gen1 = rec_datagen1.flow(
-        rec_train[:, :, :, 0, np.newaxis],
-        batch_size=cfg["params"]["BATCH_SIZE"],
-        seed=seed,
-    )
-    rec_gen2 = rec_datagen1.flow(
-        rec_train[:, :, :, 1, np.newaxis],
-        batch_size=cfg["params"]["BATCH_SIZE"],
-        seed=seed,
-    )
+    mask = np.stack([poisson_mask(shape, cfg["params"]["ACCEL"], seed + k, circle) for k in range(num)])
 
-    def combine_generator(gen1, gen2, mask, stats):
-        while True:
-            rec_real = gen1.next()
-            rec_imag = gen2.next()
-            rec = np.zeros((rec_real.shape[0], rec_real.shape[1], rec_real.shape[2], 2))
-            rec[:, :, :, 0] = rec_real[:, :, :, 0]
-            rec[:, :, :, 1] = rec_imag[:, :, :, 0]
+    sampling = (1.0 * mask.sum() / mask.size) * 100
+    logging.info("masks generated: " + str(num) + ", " + str(int(sampling)) + "% masked")
 
-            dec = np.fft.fft2(rec_real[:, :, :, 0] + 1j * rec_imag[:, :, :, 0])
-            dec2 = np.zeros((dec.shape[0], dec.shape[1], dec.shape[2], 2))
-            dec2[:, :, :, 0] = dec.real
-            dec2[:, :, :, 1] = dec.imag
-            dec2[
-                :, mask[int(random.randint(0, (cfg["params"]["NUM_MASKS"] - 1)))], :
-            ] = 0
+    os.makedirs(str(path.parent), exist_ok=True)
+    tmp = str(path) + ".tmp" + str(os.getpid()) + ".npz"
+    np.savez(tmp, bits=np.packbits(mask.reshape(num, -1), axis=1), shape=mask.shape[1:], count=num)
+    os.replace(tmp, str(path))
 
-            aux = np.fft.ifft2(dec2[:, :, :, 0] + 1j * dec2[:, :, :, 1])
-            dec = np.copy(dec2)
-            dec[:, :, :, 0] = aux.real
-            dec[:, :, :, 1] = aux.imag
+    return
 
-            dec = dec.astype('float32')
-            rec = rec.astype('float32')
-            
-            yield (dec, rec)
 
-    return combine_generator(rec_gen1, rec_gen2, mask, stats)
+# Returns an image generator which generates images, undersampled and complete
+# Shuffling, masks and augmentations are drawn per sample from (SEED, epoch, index) with the counter-based RNG,
+# so a batch only depends on its position in training, and matches the same batch of data_pipeline.
+# start skips that many batches, e.g. when resuming.
+# Each batch is warped as one (N, H, W, 2) tensor, one bilinear resampling per slice for both channels.
+# Undersampled images carry their mask as a third channel when mask_input(cfg).
+def data_aug(rec_train, mask, stats, cfg, start=0):
+    seed = data_seed(cfg)
+    with_mask = mask_input(cfg)
+    n, h, w = rec_train.shape[0], rec_train.shape[1], rec_train.shape[2]
+    batch_size = cfg["params"]["BATCH_SIZE"]
+    per_epoch = int(np.ceil(n / batch_size))
+
+    def combine_generator(step):
+        order_epoch = None
+        while True:
+            epoch, pos = divmod(step, per_epoch)
+            if epoch != order_epoch:
+                order = epoch_order(seed, epoch, n).numpy()
+                order_epoch = epoch
+
+            # Sorted reads keep memory-mapped access sequential, the draws follow each index
+            indexes = np.sort(order[pos * batch_size:(pos + 1) * batch_size])
+            epochs = np.full(len(indexes), epoch, dtype=np.int64)
+            rec = augment_batch(
+                np.asarray(rec_train[indexes], dtype=np.float32),
+                sample_transforms(stateless_seeds(seed, epochs, indexes, AUG_STREAM), h, w),
+            )
+
+            keep = ~mask[sample_masks(seed, epochs, indexes, cfg["params"]["NUM_MASKS"]).numpy()]
+            dec = undersample(rec, tf.cast(keep, tf.complex64)).numpy()
+            if with_mask:
+                dec = np.concatenate([dec, keep[:, :, :, None].astype(np.float32)], axis=3)
+
+            step += 1
+            yield (dec, rec.numpy())
+
+    return combine_generator(start)
+
+
+# Returns (batch, 8) projective transforms for random affine augmentations, used by ImageProjectiveTransformV2.
+# Rotation, shift, shear and zoom about the image centre, composed as in keras' ImageDataGenerator.
+# theta and shear in radians, tx and ty in pixels (rows, cols), zx and zy as zoom factors.
+def affine_transforms(theta, tx, ty, shear, zx, zy, h, w):
+
+    cos = tf.cos(theta)
+    sin = tf.sin(theta)
+
+    # Linear part and translation of rotation @ shift @ shear @ zoom, in (row, col) coordinates
+    l00 = cos * zx
+    l01 = -tf.sin(theta + shear) * zy
+    l10 = sin * zx
+    l11 = tf.cos(theta + shear) * zy
+    b0 = cos * tx - sin * ty
+    b1 = sin * tx + cos * ty
+
+    # Moves the origin to the image centre
+    o0 = h / 2.0 - 0.5
+    o1 = w / 2.0 - 0.5
+    b0 = b0 + o0 - l00 * o0 - l01 * o1
+    b1 = b1 + o1 - l10 * o0 - l11 * o1
+
+    # The op maps output (x, y) = (col, row) to input coordinates
+    zeros = tf.zeros_like(theta)
+    return tf.stack([l11, l10, b1, l01, l00, b0, zeros, zeros], axis=1)
+
+
+# Maps (N, 6) uniform draws in [0, 1) to affine transforms. Ranges are rotation 40 degrees, shift 0.075,
+# shear 0.25 degrees and zoom 0.25, the ImageDataGenerator settings the augmentation was first written with.
+def uniform_transforms(u, h, w):
+
+    theta = (u[:, 0] * 80.0 - 40.0) * np.pi / 180.0
+    tx = (u[:, 1] * 0.15 - 0.075) * h
+    ty = (u[:, 2] * 0.15 - 0.075) * w
+    shear = (u[:, 3] * 0.5 - 0.25) * np.pi / 180.0
+    zx = u[:, 4] * 0.5 + 0.75
+    zy = u[:, 5] * 0.5 + 0.75
+
+    return affine_transforms(theta, tx, ty, shear, zx, zy, h, w)
+
+
+# Draws one random affine transform per seed. seeds is (N, 2), from stateless_seeds.
+def sample_transforms(seeds, h, w):
+
+    u = tf.map_fn(lambda seed: tf.random.stateless_uniform([6], seed), seeds, dtype=tf.float32)
+    return uniform_transforms(u, h, w)
+
+
+# Warps a batch of 2 channel images, one bilinear resampling per image for both channels.
+# Pixels mapped from outside the image are reflected, NEAREST fill only exists from TF 2.4 and 2.3 is pinned.
+def augment_batch(rec, transforms):
+    return tf.raw_ops.ImageProjectiveTransformV2(
+        images=rec,
+        transforms=transforms,
+        output_shape=tf.shape(rec)[1:3],
+        interpolation="BILINEAR",
+        fill_mode="REFLECT",
+    )
+
+
+# Undersamples a batch of 2 channel images in k-space. keep is 1 where k-space is sampled, (H, W) or one per image.
+def undersample(rec, keep):
+    dec = tf.signal.fft2d(tf.complex(rec[:, :, :, 0], rec[:, :, :, 1]))
+    dec = tf.signal.ifft2d(dec * keep)
+    return tf.stack([tf.math.real(dec), tf.math.imag(dec)], axis=3)
+
+
+# Returns a tf.data pipeline which generates images, undersampled and complete.
+# Same batches as data_aug, drawn from the same stateless ops, but runs in graph and in parallel.
+# Shuffling, masks and augmentations come from stateless ops seeded by (SEED, epoch, index), so parallel
+# maps, sharded workers and resumed runs all see the same batches.
+# rec_train is never copied into the graph, batches are gathered from it by index.
+# shard is (number of shards, this shard), each shard draws from its own slice of every epoch.
+# start skips that many batches of indexes, before any image is loaded.
+def data_pipeline(rec_train, mask, stats, cfg, shard=(1, 0), start=0):
+    seed = data_seed(cfg)
+    n = rec_train.shape[0]
+    h, w = rec_train.shape[1], rec_train.shape[2]
+    keep = tf.constant(~mask)
+    with_mask = mask_input(cfg)
+
+    def gather(indexes):
+        return np.asarray(rec_train[indexes], dtype=np.float32)
+
+    def epoch_batches(epoch):
+        order = epoch_order(seed, epoch, n)[shard[1]::shard[0]]
+        dataset = tf.data.Dataset.from_tensor_slices((tf.fill(tf.shape(order), epoch), order))
+        return dataset.batch(cfg["params"]["BATCH_SIZE"])
+
+    def load(epochs, indexes):
+        # Sorted reads keep memory-mapped access sequential, the draws follow each index
+        indexes = tf.sort(indexes)
+        rec = tf.numpy_function(gather, [indexes], tf.float32)
+        rec.set_shape((None, h, w, 2))
+        rec = augment_batch(rec, sample_transforms(stateless_seeds(seed, epochs, indexes, AUG_STREAM), h, w))
+        kept = tf.gather(keep, sample_masks(seed, epochs, indexes, cfg["params"]["NUM_MASKS"]))
+        dec = undersample(rec, tf.cast(kept, tf.complex64))
+        if with_mask:
+            dec = tf.concat([dec, tf.cast(kept, tf.float32)[:, :, :, None]], axis=3)
+        return dec, rec
+
+    dataset = tf.data.experimental.Counter().flat_map(epoch_batches).skip(start)
+    dataset = dataset.map(load, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    return dataset
+
+
+# Returns the training input for model.fit, the python generator or the tf.data pipeline.
+# Generator batches are timed for ProfileCallback.
+# With more than one replica the tf.data pipeline is always used, sharded per worker with BATCH_SIZE per replica.
+# start is the number of batches already trained on, when resuming.
+def train_input(rec_train, mask, stats, cfg, strategy=None, start=0):
+    if strategy is not None and strategy.num_replicas_in_sync > 1:
+        if cfg["params"].get("PIPELINE", "generator") != "tf.data":
+            logging.info("distributed training uses the tf.data pipeline")
+        distribute = getattr(strategy, "distribute_datasets_from_function", None) or getattr(
+            strategy, "experimental_distribute_datasets_from_function"
+        )
+        return distribute(
+            lambda context: data_pipeline(
+                rec_train,
+                mask,
+                stats,
+                cfg,
+                shard=(context.num_input_pipelines, context.input_pipeline_id),
+                start=start * context.num_replicas_in_sync // context.num_input_pipelines,
+            )
+        )
+    if cfg["params"].get("PIPELINE", "generator") == "tf.data":
+        return data_pipeline(rec_train, mask, stats, cfg, start=start)
+    return timed_batches(data_aug(rec_train, mask, stats, cfg, start), "data_aug")
 
 
 # Loss function
+# Always computed in float32, so it stays finite when the model runs in float16
 def nrmse(y_true, y_pred):
-    denom = K.sqrt(K.mean(K.square(y_true), axis=(1, 2, 3)))
+    y_true = K.cast(y_true, "float32")
+    y_pred = K.cast(y_pred, "float32")
+    denom = K.maximum(K.sqrt(K.mean(K.square(y_true), axis=(1, 2, 3))), K.epsilon())
     return K.sqrt(K.mean(K.square(y_pred - y_true), axis=(1, 2, 3))) / denom
 
 # IFFT layer, used in u_net
+# The FFT only takes complex64, so half precision inputs are cast up first
 def ifft_layer(dec):
-    real = layers.Lambda(lambda dec: dec[:, :, :, 0])(dec)
-    imag = layers.Lambda(lambda dec: dec[:, :, :, 1])(dec)
+    real = layers.Lambda(lambda dec: K.cast(dec[:, :, :, 0], "float32"))(dec)
+    imag = layers.Lambda(lambda dec: K.cast(dec[:, :, :, 1], "float32"))(dec)
     dec_complex = tf.complex(real, imag)
-    rec1 = tf.abs(tf.ifft2d(dec_complex))
+    rec1 = tf.abs(tf.signal.ifft2d(dec_complex))
     rec1 = tf.expand_dims(rec1, -1)
     return rec1
 
 
 # Gets training data and val data
 # Note: In train, one file is (174 x 256 x 256). This code is fine with that
+@timed("get_brains")
 def get_brains(cfg, ADDR):
 
-    dec_files_train = np.asarray(glob.glob(str(ADDR / cfg["addrs"]["TRAIN"])))
-    dec_files_val = np.asarray(glob.glob(str(ADDR / cfg["addrs"]["VAL"])))
+    store_train = open_store(ADDR, cfg["addrs"]["TRAIN"], cfg["params"].get("READ_WORKERS", 4))
+    store_val = open_store(ADDR, cfg["addrs"]["VAL"], cfg["params"].get("READ_WORKERS", 4))
 
-    logging.info("train scans: " + str(len(dec_files_train)))
-    logging.info("val scans: " + str(len(dec_files_val)))
+    logging.info("train scans: " + str(len(store_train.paths)) + ", slices: " + str(len(store_train)))
+    logging.info("val scans: " + str(len(store_val.paths)) + ", slices: " + str(len(store_val)))
     logging.debug("Scans loaded")
 
-    shape = (256, 256)
-    norm = np.sqrt(shape[0] * shape[1])
+    shape = tuple(store_train.slice_shape[:2])
+    if tuple(store_val.slice_shape[:2]) != shape:
+        raise ValueError(
+            "val slice shape " + str(tuple(store_val.slice_shape[:2])) + " does not match train " + str(shape)
+        )
+    logging.info("slice shape: " + str(shape))
 
-    mask = np.zeros((cfg["params"]["NUM_MASKS"], shape[0], shape[1]))
-    masks = np.asarray(glob.glob(str(ADDR / cfg["addrs"]["MASKS"])))
-    for i in range(len(masks)):
-        mask[i] = np.load(masks[i])
-    mask = mask.astype(bool)
-    logging.info("masks: " + str(len(mask)))
+    mask = load_masks(cfg, ADDR, shape)
 
-    ntrain = 0
-    for ii in range(len(dec_files_train)):
-        ntrain += np.load(dec_files_train[ii]).shape[0]
-
-    rec_train = np.zeros((ntrain, shape[0], shape[1], 2))
-    dec_train = np.zeros((ntrain, shape[0], shape[1], 2))
-    aux_counter = 0
-    for ii in range(len(dec_files_train)):
-        dec1 = np.load(dec_files_train[ii]) / norm
-        rec1 = np.copy(dec1)
-        dec1[:, mask[int(random.randint(0, cfg["params"]["NUM_MASKS"] - 1))], :] = 0
-        dec2 = np.fft.ifft2(dec1[:, :, :, 0] + 1j * dec1[:, :, :, 1])
-        rec2 = np.fft.ifft2(rec1[:, :, :, 0] + 1j * rec1[:, :, :, 1])
-        aux = rec1.shape[0]
-        dec_train[aux_counter : aux_counter + aux, :, :, 0] = dec2.real
-        dec_train[aux_counter : aux_counter + aux, :, :, 1] = dec2.imag
-        rec_train[aux_counter : aux_counter + aux, :, :, 0] = rec2.real
-        rec_train[aux_counter : aux_counter + aux, :, :, 1] = rec2.imag
-        aux_counter += aux
-
-    indexes = np.arange(rec_train.shape[0], dtype=int)
-    np.random.shuffle(indexes)
-    rec_train = rec_train[indexes]
-    dec_train = dec_train[indexes]
-
-    dec_train = dec_train[: cfg["params"]["NUM_TRAIN"], :, :, :]
-    rec_train = rec_train[: cfg["params"]["NUM_TRAIN"], :, :, :]
-
-    dec_train = dec_train / np.max(np.abs(dec_train[:, :, :, 0] + 1j * dec_train[:, :, :, 1]))
-    rec_train = rec_train / np.max(np.abs(rec_train[:, :, :, 0] + 1j * rec_train[:, :, :, 1]))
-
-    dec_train = dec_train.astype('float32')
-    rec_train = rec_train.astype('float32')
-
-    logging.info("dec train: " + str(dec_train.shape))
+    # LEAN_LOAD builds in float32 and skips dec_train, which augmentation regenerates anyway
+    lean = cfg["params"].get("LEAN_LOAD", False)
+    dtype = np.float32 if lean else np.float64
+
+    def build_train():
+        dec_train, rec_train = load_slices(
+            store_train,
+            cfg["params"]["NUM_TRAIN"],
+            mask,
+            cfg,
+            shape,
+            split_rng(cfg, "train"),
+            dtype=dtype,
+            with_dec=not lean,
+            with_mask=mask_input(cfg),
+        )
+
+        rec_train = normalize(rec_train).astype('float32', copy=False)
+        if dec_train is not None:
+            dec_train = normalize(dec_train).astype('float32', copy=False)
+
+        return dec_train, rec_train
+
+    dec_train, rec_train = cached_slices(cfg, ADDR, "train", store_train.files, mask, build_train)
+
+    logging.info("dec train: " + (str(dec_train.shape) if dec_train is not None else "skipped"))
     logging.info("rec train: " + str(rec_train.shape))
 
-    nval = 0
-    for ii in range(len(dec_files_val)):
-        nval += np.load(dec_files_val[ii]).shape[0]
-
-    rec_val = np.zeros((nval, shape[0], shape[1], 2))
-    dec_val = np.zeros((nval, shape[0], shape[1], 2))
-    aux_counter = 0
-    for ii in range(len(dec_files_val)):
-        dec1 = np.load(dec_files_val[ii]) / norm
-        rec1 = np.copy(dec1)
-        dec1[:, mask[int(random.randint(0, cfg["params"]["NUM_MASKS"] - 1))], :] = 0
-        dec2 = np.fft.ifft2(dec1[:, :, :, 0] + 1j * dec1[:, :, :, 1])
-        rec2 = np.fft.ifft2(rec1[:, :, :, 0] + 1j * rec1[:, :, :, 1])
-        aux = rec1.shape[0]
-        dec_val[aux_counter : aux_counter + aux, :, :, 0] = dec2.real
-        dec_val[aux_counter : aux_counter + aux, :, :, 1] = dec2.imag
-        rec_val[aux_counter : aux_counter + aux, :, :, 0] = rec2.real
-        rec_val[aux_counter : aux_counter + aux, :, :, 1] = rec2.imag
-        aux_counter += aux
-
-    indexes = np.arange(rec_val.shape[0], dtype=int)
-    np.random.shuffle(indexes)
-    rec_val = rec_val[indexes]
-    dec_val = dec_val[indexes]
-    dec_val[:, mask[int(random.randint(0, cfg["params"]["NUM_MASKS"] - 1))], :] = 0
-
-    dec_val = dec_val[: cfg["params"]["NUM_VAL"], :, :, :]
-    rec_val = rec_val[: cfg["params"]["NUM_VAL"], :, :, :]
-
-    dec_val = dec_val / np.max(np.abs(dec_val[:, :, :, 0] + 1j * dec_val[:, :, :, 1]))
-    rec_val = rec_val / np.max(np.abs(rec_val[:, :, :, 0] + 1j * rec_val[:, :, :, 1]))
-
-    dec_val = dec_val.astype('float32')
-    rec_val = rec_val.astype('float32')
+    def build_val():
+        rng = split_rng(cfg, "val")
+        dec_val, rec_val = load_slices(
+            store_val, cfg["params"]["NUM_VAL"], mask, cfg, shape, rng, dtype=dtype, with_mask=mask_input(cfg)
+        )
+        dec_val[:, mask[int(rng.randint(0, cfg["params"]["NUM_MASKS"]))], :2] = 0
+
+        dec_val = normalize(dec_val).astype('float32', copy=False)
+        rec_val = normalize(rec_val).astype('float32', copy=False)
+
+        return dec_val, rec_val
+
+    dec_val, rec_val = cached_slices(cfg, ADDR, "val", store_val.files, mask, build_val)
 
     logging.info("dec val: " + str(dec_val.shape))
     logging.info("rec val: " + str(rec_val.shape))
 
     logging.debug("Scans formatted")
-
-    stats = np.zeros(4)
-    stats[0] = dec_train.mean()
-    stats[1] = dec_train.std()
-    aux = np.abs(rec_train[:, :, :, 0] + 1j * rec_train[:, :, :, 1])
-    stats[2] = aux.mean()
-    stats[3] = aux.std()
+    logging.info("peak RSS after loading: " + str(peak_rss()) + " MB")
+
+    # dec stats are NaN when dec_train is skipped
+    stats = np.full(4, np.nan)
+    if dec_train is not None:
+        stats[0] = dec_train[:, :, :, :2].mean()
+        stats[1] = dec_train[:, :, :, :2].std()
+    stats[2], stats[3] = magnitude_stats(rec_train)
     np.save(str(ADDR / cfg["addrs"]["STATS"]), stats)
 
     return (
@@ -352,128 +606,281 @@ def get_brains(cfg, ADDR):
     )
 
 
+# Sets the global Keras dtype policy: float32, mixed_float16 or mixed_bfloat16 (or float16/bfloat16 for inference).
+# Uses the experimental API on older TF versions.
+def set_precision(policy):
+    if hasattr(tf.keras.mixed_precision, "set_global_policy"):
+        tf.keras.mixed_precision.set_global_policy(policy)
+    else:
+        tf.keras.mixed_precision.experimental.set_policy(policy)
+    return policy
+
+
+# Wraps an optimizer with dynamic loss scaling when training in mixed float16.
+# bfloat16 has the range of float32, so it needs no loss scaling.
+def scale_loss(opt, policy):
+    if policy != "mixed_float16":
+        return opt
+    if hasattr(tf.keras.mixed_precision, "LossScaleOptimizer"):
+        return tf.keras.mixed_precision.LossScaleOptimizer(opt)
+    return tf.keras.mixed_precision.experimental.LossScaleOptimizer(opt, loss_scale="dynamic")
+
+
+# Returns a copy of a trained model built entirely in float16 or bfloat16, for inference.
+# builder is from model_builder. The global policy is restored afterwards.
+def inference_copy(model, builder, cfg, dtype):
+    mp = tf.keras.mixed_precision
+    policy = (mp.global_policy() if hasattr(mp, "global_policy") else mp.experimental.global_policy()).name
+    set_precision(dtype)
+    half = builder(cfg, H=model.input_shape[1], W=model.input_shape[2])
+    half.set_weights(model.get_weights())
+    set_precision(policy)
+    return half
+
+
 # Custom complex convolution.
 # Uses algebra below. I've used "|" to denote a two channel array, and "f" to denote a variable that is a part of a filter.
 # (R | I) * (Rf | If) = Or | Oi = (R * Rf - I * If) | (I * Rf + R * If)
+# With fused=True the four convolutions run as one: R and I are stacked on the batch axis and Rf and If
+# on the output channel axis, giving R * Rf, R * If, I * Rf and I * If from a single conv2d.
+# Both paths use the same convreal/convimag weights, so checkpoints load into either.
 class CompConv2D(layers.Layer):
-    def __init__(self, out_channels, kshape=(3, 3), **kwargs):
-        super(CompConv2D, self).__init__()
+    def __init__(self, out_channels, kshape=(3, 3), fused=False, activation="relu", **kwargs):
+        super(CompConv2D, self).__init__(**kwargs)
         self.out_channels = out_channels
+        self.kshape = tuple(kshape)
+        self.fused = fused
+        self.activation = activation
         self.convreal = layers.Conv2D(
-            out_channels, kshape, activation="relu", padding="same"
+            out_channels, kshape, activation=activation, padding="same"
         )
         self.convimag = layers.Conv2D(
-            out_channels, kshape, activation="relu", padding="same"
+            out_channels, kshape, activation=activation, padding="same"
         )
 
+    def build(self, input_shape):
+        input_shape = tf.TensorShape(input_shape)
+        half_shape = input_shape[:-1].concatenate([input_shape[-1] // 2])
+        self.convreal.build(half_shape)
+        self.convimag.build(half_shape)
+        super(CompConv2D, self).build(input_shape)
+
     def call(self, input_tensor, training=False):
         ureal, uimag = tf.split(input_tensor, num_or_size_splits=2, axis=3)
-        oreal = self.convreal(ureal) - self.convimag(uimag)
-        oimag = self.convimag(ureal) + self.convreal(uimag)
-        x = tf.concat([oreal, oimag], axis=3)
+        if not self.fused:
+            oreal = self.convreal(ureal) - self.convimag(uimag)
+            oimag = self.convimag(ureal) + self.convreal(uimag)
+            x = tf.concat([oreal, oimag], axis=3)
+            return x
+
+        # Variables are cast to the input dtype, which is float16/bfloat16 under a mixed policy
+        kernel = tf.concat([self.convreal.kernel, self.convimag.kernel], axis=3)
+        kernel = tf.cast(kernel, input_tensor.dtype)
+        bias = tf.cast(tf.concat([self.convreal.bias, self.convimag.bias], axis=0), input_tensor.dtype)
+        x = tf.nn.conv2d(tf.concat([ureal, uimag], axis=0), kernel, strides=1, padding="SAME")
+        x = self.convreal.activation(tf.nn.bias_add(x, bias))
+
+        xreal, ximag = tf.split(x, num_or_size_splits=2, axis=0)
+        real_real, real_imag = tf.split(xreal, num_or_size_splits=2, axis=3)
+        imag_real, imag_imag = tf.split(ximag, num_or_size_splits=2, axis=3)
+        x = tf.concat([real_real - imag_imag, real_imag + imag_real], axis=3)
         return x
 
     def get_config(self):
         config = {
-            "convreal": self.convreal,
-            "convimag": self.convimag,
             "out_channels": self.out_channels,
+            "kshape": self.kshape,
+            "fused": self.fused,
+            "activation": self.activation,
         }
         base_config = super(CompConv2D, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
+    # Models saved before get_config was serializable stored the two Conv2D layers, they are rebuilt instead
+    @classmethod
+    def from_config(cls, config):
+        config = dict(config)
+        config.pop("convreal", None)
+        config.pop("convimag", None)
+        return cls(**config)
+
+
+# Custom objects of saved U-Nets, for load_model.
+CUSTOM_OBJECTS = dict(COMPLEX_OBJECTS, CompConv2D=CompConv2D, nrmse=nrmse)
+
+
+# Zero pads a model input so H and W are multiples of 2^depth (8 for three pooling levels).
+# Returns the padded tensor and the padding, for crop_to_input.
+def pad_to_pool(inputs, H, W, multiple=8):
+    pad_h = -H % multiple
+    pad_w = -W % multiple
+    padding = ((pad_h // 2, pad_h - pad_h // 2), (pad_w // 2, pad_w - pad_w // 2))
+    if pad_h == 0 and pad_w == 0:
+        return inputs, padding
+    return layers.ZeroPadding2D(padding=padding)(inputs), padding
+
+
+# Crops a model tensor back to the input size after pad_to_pool.
+def crop_to_input(outputs, padding):
+    if padding == ((0, 0), (0, 0)):
+        return outputs
+    return layers.Cropping2D(cropping=padding)(outputs)
+
+
+# Widths of the default U-Nets per level, before MOD/RE_MOD. Deeper U-Nets keep doubling the last width.
+COMP_WIDTHS = [24, 32, 64, 128]
+REAL_WIDTHS = [48, 64, 128, 256]
+
+
+# Returns the channel widths of every level of a U-Net kind, "comp" or "real", from the top level to the bottom.
+# COMP_WIDTHS/REAL_WIDTHS give them directly, otherwise they are the defaults for DEPTH scaled by MOD/RE_MOD.
+# A comp width counts complex channels, each one is two real channels.
+def level_widths(cfg, kind):
+    depth = cfg["params"].get("DEPTH", 3)
+    widths = cfg["params"].get(kind.upper() + "_WIDTHS")
+    if widths is None:
+        base = COMP_WIDTHS if kind == "comp" else REAL_WIDTHS
+        base = base + [base[-1] * 2 ** (ii + 1) for ii in range(depth + 1 - len(base))]
+        scale = cfg["params"]["MOD"] if kind == "comp" else cfg["params"]["RE_MOD"]
+        widths = [width * scale for width in base[: depth + 1]]
+    if len(widths) != depth + 1:
+        raise ValueError(
+            kind.upper() + "_WIDTHS needs DEPTH + 1 = " + str(depth + 1) + " widths, got " + str(len(widths))
+        )
+    return list(widths)
 
-# U-Net model. Uses custom complex layer.
-def comp_unet_model(
-    cfg, H=256, W=256, channels=2, kshape=(3, 3)
-):
-    MOD = cfg["params"]["MOD"]
-
-    inputs = layers.Input(shape=(H, W, channels))
-
-    conv1 = CompConv2D(24 * MOD)(inputs)
-    conv1 = CompConv2D(24 * MOD)(conv1)
-    conv1 = CompConv2D(24 * MOD)(conv1)
-    pool1 = layers.MaxPooling2D(pool_size=(2, 2))(conv1)
-
-    conv2 = CompConv2D(32 * MOD)(pool1)
-    conv2 = CompConv2D(32 * MOD)(conv2)
-    conv2 = CompConv2D(32 * MOD)(conv2)
-    pool2 = layers.MaxPooling2D(pool_size=(2, 2))(conv2)
-
-    conv3 = CompConv2D(64 * MOD)(pool2)
-    conv3 = CompConv2D(64 * MOD)(conv3)
-    conv3 = CompConv2D(64 * MOD)(conv3)
-    pool3 = layers.MaxPooling2D(pool_size=(2, 2))(conv3)
-
-    conv4 = CompConv2D(128 * MOD)(pool3)
-    conv4 = CompConv2D(128 * MOD)(conv4)
-    conv4 = CompConv2D(128 * MOD)(conv4)
-
-    up1 = layers.concatenate([layers.UpSampling2D(size=(2, 2))(conv4), conv3], axis=-1)
-    conv5 = CompConv2D(64 * MOD)(up1)
-    conv5 = CompConv2D(64 * MOD)(conv5)
-    conv5 = CompConv2D(64 * MOD)(conv5)
-
-    up2 = layers.concatenate([layers.UpSampling2D(size=(2, 2))(conv5), conv2], axis=-1)
-    conv6 = CompConv2D(32 * MOD)(up2)
-    conv6 = CompConv2D(32 * MOD)(conv6)
-    conv6 = CompConv2D(32 * MOD)(conv6)
-
-    up3 = layers.concatenate([layers.UpSampling2D(size=(2, 2))(conv6), conv1], axis=-1)
-    conv7 = CompConv2D(24 * MOD)(up3)
-    conv7 = CompConv2D(24 * MOD)(conv7)
-    conv7 = CompConv2D(24 * MOD)(conv7)
-
-    conv8 = layers.Conv2D(2, (1, 1), activation="linear")(conv7)
-
-    model = Model(inputs=inputs, outputs=conv8)
-    return model
 
+# One level of the complex U-Net, convs CompConv2D.
+# With COMPLEX_LAYERS the convs are linear complex convs, each followed by the complex activation ACTIVATION
+# and, with COMPLEX_BN, a CompBatchNorm. Otherwise each real conv of a CompConv2D has its own ReLU.
+def comp_block(x, out_channels, cfg, convs=3, kshape=(3, 3)):
+    FUSED = cfg["params"].get("FUSED", False)
+    if not cfg["params"].get("COMPLEX_LAYERS", False):
+        for _ in range(convs):
+            x = CompConv2D(out_channels, kshape, fused=FUSED)(x)
+        return x
 
-# U-Net model.
-def real_unet_model(
-    cfg, H=256, W=256, channels=2, kshape=(3, 3)
-):
-    RE_MOD = cfg["params"]["RE_MOD"]
+    for _ in range(convs):
+        x = CompConv2D(out_channels, kshape, fused=FUSED, activation=None)(x)
+        if cfg["params"].get("COMPLEX_BN", False):
+            x = CompBatchNorm()(x)
+        x = comp_activation(cfg["params"].get("ACTIVATION", "crelu"))(x)
+    return x
 
-    inputs = Input(shape=(H, W, channels))
 
-    conv1 = Conv2D(48 * RE_MOD, kshape, activation="relu", padding="same")(inputs)
-    conv1 = Conv2D(48 * RE_MOD, kshape, activation="relu", padding="same")(conv1)
-    conv1 = Conv2D(48 * RE_MOD, kshape, activation="relu", padding="same")(conv1)
-    pool1 = MaxPooling2D(pool_size=(2, 2))(conv1)
+# Downsampling of the complex U-Net, max pooling by magnitude with COMPLEX_LAYERS.
+def comp_pool(x, cfg):
+    if cfg["params"].get("COMPLEX_LAYERS", False):
+        return CompMaxPool2D(pool_size=2)(x)
+    return layers.MaxPooling2D(pool_size=(2, 2))(x)
+
+
+# Upsampling and skip connection of the complex U-Net.
+# With COMPLEX_LAYERS a complex transposed conv, and real and imaginary channels are concatenated separately.
+def comp_up(x, skip, cfg):
+    if cfg["params"].get("COMPLEX_LAYERS", False):
+        x = CompConv2DTranspose(int(skip.shape[-1]) // 2)(x)
+        return CompConcatenate()([x, skip])
+    return layers.concatenate([layers.UpSampling2D(size=(2, 2))(x), skip], axis=-1)
+
 
-    conv2 = Conv2D(64 * RE_MOD, kshape, activation="relu", padding="same")(pool1)
-    conv2 = Conv2D(64 * RE_MOD, kshape, activation="relu", padding="same")(conv2)
-    conv2 = Conv2D(64 * RE_MOD, kshape, activation="relu", padding="same")(conv2)
-    pool2 = MaxPooling2D(pool_size=(2, 2))(conv2)
+# One level of the real U-Net, convs ReLU Conv2D.
+def real_block(x, out_channels, cfg, convs=3, kshape=(3, 3)):
+    for _ in range(convs):
+        x = Conv2D(out_channels, kshape, activation="relu", padding="same")(x)
+    return x
 
-    conv3 = Conv2D(128 * RE_MOD, kshape, activation="relu", padding="same")(pool2)
-    conv3 = Conv2D(128 * RE_MOD, kshape, activation="relu", padding="same")(conv3)
-    conv3 = Conv2D(128 * RE_MOD, kshape, activation="relu", padding="same")(conv3)
-    pool3 = MaxPooling2D(pool_size=(2, 2))(conv3)
 
-    conv4 = Conv2D(256 * RE_MOD, kshape, activation="relu", padding="same")(pool3)
-    conv4 = Conv2D(256 * RE_MOD, kshape, activation="relu", padding="same")(conv4)
-    conv4 = Conv2D(256 * RE_MOD, kshape, activation="relu", padding="same")(conv4)
+# Downsampling of the real U-Net.
+def real_pool(x, cfg):
+    return MaxPooling2D(pool_size=(2, 2))(x)
 
-    up1 = concatenate([UpSampling2D(size=(2, 2))(conv4), conv3], axis=-1)
-    conv5 = Conv2D(128 * RE_MOD, kshape, activation="relu", padding="same")(up1)
-    conv5 = Conv2D(128 * RE_MOD, kshape, activation="relu", padding="same")(conv5)
-    conv5 = Conv2D(128 * RE_MOD, kshape, activation="relu", padding="same")(conv5)
 
-    up2 = concatenate([UpSampling2D(size=(2, 2))(conv5), conv2], axis=-1)
-    conv6 = Conv2D(64 * RE_MOD, kshape, activation="relu", padding="same")(up2)
-    conv6 = Conv2D(64 * RE_MOD, kshape, activation="relu", padding="same")(conv6)
-    conv6 = Conv2D(64 * RE_MOD, kshape, activation="relu", padding="same")(conv6)
+# Upsampling and skip connection of the real U-Net.
+def real_up(x, skip, cfg):
+    return concatenate([UpSampling2D(size=(2, 2))(x), skip], axis=-1)
 
-    up3 = concatenate([UpSampling2D(size=(2, 2))(conv6), conv1], axis=-1)
-    conv7 = Conv2D(48 * RE_MOD, kshape, activation="relu", padding="same")(up3)
-    conv7 = Conv2D(48 * RE_MOD, kshape, activation="relu", padding="same")(conv7)
-    conv7 = Conv2D(48 * RE_MOD, kshape, activation="relu", padding="same")(conv7)
 
-    conv8 = layers.Conv2D(2, (1, 1), activation="linear")(conv7)
+# U-Net of either kind, "comp" (custom complex layers) or "real".
+# Widths per level come from level_widths, DEPTH pooling levels and CONVS convs per level.
+# Any H and W work, inputs are padded to multiples of 2^DEPTH inside the model and outputs cropped back.
+# Layers follow the global dtype policy, except the output layer which is always float32.
+def unet_model(cfg, H=256, W=256, channels=2, kshape=(3, 3), kind="comp"):
+    widths = level_widths(cfg, kind)
+    convs = cfg["params"].get("CONVS", 3)
+    block, pool, up = (comp_block, comp_pool, comp_up) if kind == "comp" else (real_block, real_pool, real_up)
 
-    model = Model(inputs=inputs, outputs=conv8)
+    inputs = Input(shape=(H, W, channels))
+    x, padding = pad_to_pool(inputs, H, W, multiple=2 ** (len(widths) - 1))
+
+    skips = []
+    for width in widths[:-1]:
+        x = block(x, width, cfg, convs, kshape)
+        skips.append(x)
+        x = pool(x, cfg)
+    x = block(x, widths[-1], cfg, convs, kshape)
+
+    for width, skip in zip(reversed(widths[:-1]), reversed(skips)):
+        x = up(x, skip, cfg)
+        x = block(x, width, cfg, convs, kshape)
+
+    x = crop_to_input(x, padding)
+    outputs = layers.Conv2D(2, (1, 1), activation="linear", dtype="float32")(x)
+
+    model = Model(inputs=inputs, outputs=outputs)
+    return model
+
+
+# U-Net model. Uses custom complex layer.
+def comp_unet_model(cfg, H=256, W=256, channels=2, kshape=(3, 3)):
+    return unet_model(cfg, H, W, channels, kshape, kind="comp")
+
+
+# U-Net model.
+def real_unet_model(cfg, H=256, W=256, channels=2, kshape=(3, 3)):
+    return unet_model(cfg, H, W, channels, kshape, kind="real")
+
+
+# Cascade of U-Net blocks with data consistency, in the spirit of W-Net.
+# CASCADE is one letter per block: "i" for an image domain block, "k" for a k-space block (an orthonormal FFT
+# before and inverse FFT after). Each block adds a residual to its input and is followed by a DataConsistency
+# step that puts back the acquired k-space of the zero-filled input.
+# The input has a channel more than the blocks, the sampling mask of each slice (see mask_input).
+# block is comp_unet_model or real_unet_model, with its widths scaled by CASCADE_MOD.
+# With CASCADE_SHARED all blocks of a domain share one set of weights, so the parameter count doesn't grow with depth.
+def cascade_model(cfg, H=256, W=256, channels=2, block=comp_unet_model):
+    block_cfg = copy.deepcopy(cfg)
+    scale = cfg["params"].get("CASCADE_MOD", 1.0)
+    for name in ["MOD", "RE_MOD"]:
+        block_cfg["params"][name] = cfg["params"][name] * scale
+    for name in ["COMP_WIDTHS", "REAL_WIDTHS"]:
+        if cfg["params"].get(name) is not None:
+            block_cfg["params"][name] = [width * scale for width in cfg["params"][name]]
+    shared = cfg["params"].get("CASCADE_SHARED", False)
+
+    inputs = layers.Input(shape=(H, W, channels + 1))
+    blocks = {}
+    x = ImageChannels()(inputs)
+    for domain in cfg["params"]["CASCADE"]:
+        if domain not in blocks or not shared:
+            blocks[domain] = block(block_cfg, H=H, W=W, channels=channels)
+        if domain == "k":
+            kspace = FFT2D()(x)
+            kspace = layers.Add(dtype="float32")([kspace, blocks[domain](kspace)])
+            x = FFT2D(inverse=True)(kspace)
+        elif domain == "i":
+            x = layers.Add(dtype="float32")([x, blocks[domain](x)])
+        else:
+            raise ValueError("unknown CASCADE domain: " + str(domain))
+        x = DataConsistency()([x, inputs])
+
+    model = Model(inputs=inputs, outputs=x)
     return model
+
+
+# Returns the model builder of a U-Net kind, "comp" or "real". When CASCADE is set, a cascade of that U-Net.
+def model_builder(cfg, kind):
+    unet = comp_unet_model if kind == "comp" else real_unet_model
+    if not cfg["params"].get("CASCADE"):
+        return unet
+    return functools.partial(cascade_model, block=unet)
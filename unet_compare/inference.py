@@ -0,0 +1,111 @@
+# Streaming reconstruction of k-space slices with bounded memory.
+# Slices are read from a SliceStore (scan files or shards) a micro-batch at a time and never held whole, so peak memory
+# depends on the batch size and slice shape only, not on how many slices are reconstructed.
+# Normalization matches get_test and local_test: a first pass finds the max input magnitude,
+# the second runs the model and tracks a running max of the outputs, a last pass rescales the output in place.
+
+import logging
+import numpy as np
+from numpy.lib.format import open_memmap
+from unet_compare.functions import load_masks, split_rng, mask_input
+from unet_compare.shards import open_store
+
+
+# Yields (start, batch) over every slice of a SliceStore, in global index order.
+# Each batch is batch_size undersampled image-domain slices (N, H, W, 2) in float32, scaled by 1/scale.
+# The last batch is zero padded, start is the global index of its first slice.
+# mask is a (NUM_MASKS, H, W) bank, one mask drawn per slice with rng as in get_test, or None for already
+# undersampled data, whose mask is then where k-space is nonzero.
+# with_mask adds each slice's mask as a third channel, for cascades (see mask_input).
+def kspace_batches(store, batch_size, mask=None, rng=np.random, scale=1.0, with_mask=False):
+
+    shape = store.slice_shape[:2]
+    norm = np.sqrt(shape[0] * shape[1])
+    batch = np.zeros((batch_size, shape[0], shape[1], 3 if with_mask else 2), dtype=np.float32)
+
+    for start in range(0, len(store), batch_size):
+        kspace = store.read(np.arange(start, min(start + batch_size, len(store))))
+        kspace = (kspace[:, :, :, 0] + 1j * kspace[:, :, :, 1]) / norm
+        if mask is not None:
+            keep = ~mask[rng.randint(0, len(mask), len(kspace))]
+            kspace = kspace * keep
+        else:
+            keep = kspace != 0
+        image = np.fft.ifft2(kspace) / scale
+
+        batch[: len(image), :, :, 0] = image.real
+        batch[: len(image), :, :, 1] = image.imag
+        if with_mask:
+            batch[: len(image), :, :, 2] = keep
+        batch[len(image):] = 0
+        yield start, batch
+
+    return
+
+
+# Returns the max complex magnitude over every undersampled slice, the input normalization of get_test.
+def input_max(store, batch_size, mask=None, seed=None):
+
+    peak = 0.0
+    for _, batch in kspace_batches(store, batch_size, mask, np.random.RandomState(seed)):
+        peak = max(peak, float(np.abs(batch[:, :, :, 0] + 1j * batch[:, :, :, 1]).max()))
+
+    return peak
+
+
+# Reconstructs every slice of a SliceStore with a trained comp or real U-Net.
+# Writes a (slices, H, W, 2) float32 .npy at out_path and returns it memory-mapped.
+# seed fixes the mask drawn for each slice, both passes must see the same masks.
+# scale skips the first pass, e.g. to reuse the input max of a training set.
+# with_mask feeds the model each slice's mask as a third input channel, for cascades.
+def reconstruct(model, store, out_path, mask=None, batch_size=16, seed=None, scale=None, with_mask=False):
+
+    total = len(store)
+    shape = store.slice_shape[:2]
+
+    if scale is None:
+        scale = input_max(store, batch_size, mask, seed)
+    logging.info("input scale: " + str(scale))
+    if scale <= 0:
+        logging.warning("all input slices are zero, input left unscaled")
+        scale = 1.0
+
+    out = open_memmap(str(out_path), mode="w+", dtype=np.float32, shape=(total, shape[0], shape[1], 2))
+
+    peak = 0.0
+    batches = kspace_batches(store, batch_size, mask, np.random.RandomState(seed), scale, with_mask)
+    for start, batch in batches:
+        # Always a full batch, so the model never sees a new input shape
+        pred = np.asarray(model.predict_on_batch(batch))[: total - start]
+        out[start:start + len(pred)] = pred
+        peak = max(peak, float(np.abs(pred[:, :, :, 0] + 1j * pred[:, :, :, 1]).max()))
+
+    # All zero outputs are left as they are rather than divided by zero
+    if peak > 0:
+        for start in range(0, total, batch_size):
+            out[start:start + batch_size] /= peak
+    else:
+        logging.warning("all reconstructed slices are zero, output left unscaled")
+    out.flush()
+
+    logging.info("reconstructed slices: " + str(total) + ", written to " + str(out_path))
+
+    return open_memmap(str(out_path), mode="r")
+
+
+# Reconstructs the TEST scan files or shard directory with the configured mask bank, mask draws seeded by SEED.
+def reconstruct_test(cfg, ADDR, model, out_path):
+
+    store = open_store(ADDR, cfg["addrs"]["TEST"], cfg["params"].get("READ_WORKERS", 4))
+    mask = load_masks(cfg, ADDR, store.slice_shape[:2])
+    seed = split_rng(cfg, "recon").randint(0, 2 ** 31 - 1)
+
+    return reconstruct(
+        model,
+        store,
+        out_path,
+        mask,
+        batch_size=cfg["params"].get("BATCH_SIZE", 16),
+        seed=seed,
+        with_mask=mask_input(cfg),
+    )
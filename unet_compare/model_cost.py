@@ -0,0 +1,54 @@
+# Cost estimates of a built model, so a configuration can be checked against a latency or memory budget
+# before training. Both come from the forward graph of one traced call:
+# FLOPs per slice from the TF profiler's float op counts (multiplies and adds counted separately),
+# activation memory from every batch-sized float tensor of the forward pass, which backprop keeps in the worst case.
+# Ops without registered FLOP counts (the FFTs, elementwise ops) are left out, so FLOPs are a lower bound
+# dominated by the convolutions.
+
+import logging
+import numpy as np
+import tensorflow as tf
+
+
+# Returns the forward graph of model for inputs of the given batch size, None for a variable batch.
+def forward_graph(model, batch):
+    spec = tf.TensorSpec((batch,) + tuple(model.input_shape[1:]), tf.float32)
+    return tf.function(lambda x: model(x, training=False)).get_concrete_function(spec).graph
+
+
+# Float operations of one forward pass of a single slice.
+def slice_flops(model):
+    options = tf.compat.v1.profiler.ProfileOptionBuilder.float_operation()
+    options["output"] = "none"
+    info = tf.compat.v1.profiler.profile(
+        graph=forward_graph(model, 1), run_meta=tf.compat.v1.RunMetadata(), cmd="op", options=options
+    )
+    return int(info.total_float_ops)
+
+
+# Bytes of forward activations per slice, the tensors whose first dimension is the batch.
+def slice_activation_bytes(model):
+    total = 0
+    for op in forward_graph(model, None).get_operations():
+        for out in op.outputs:
+            shape = out.shape
+            if not (out.dtype.is_floating or out.dtype.is_complex) or shape.rank is None or shape.rank < 2:
+                continue
+            if shape[0] is not None or not shape[1:].is_fully_defined():
+                continue
+            total += int(np.prod(shape[1:].as_list())) * out.dtype.size
+    return total
+
+
+# Returns the parameter count, FLOPs per slice and activation memory per batch of a model, and logs them.
+def model_cost(model, batch_size, name="model"):
+    cost = {
+        "params": int(model.count_params()),
+        "flops_per_slice": slice_flops(model),
+        "activation_mb_per_batch": slice_activation_bytes(model) * batch_size / 2 ** 20,
+    }
+    logging.info(
+        "%s: %d params, %.2f GFLOPs per slice, %.0f MB activations per batch of %d"
+        % (name, cost["params"], cost["flops_per_slice"] / 1e9, cost["activation_mb_per_batch"], batch_size)
+    )
+    return cost
@@ -0,0 +1,218 @@
+# Training instrumentation. Times the loaders and the batch generator, and a Keras callback records every step.
+# Each step is split into data wait (gap between steps plus generator time) and compute, with steps/sec,
+# samples/sec and peak RSS per epoch. An optional step window is traced with the TF profiler.
+# Records are written as JSON lines, one object per line with an "event" field.
+
+import os
+import json
+import time
+import logging
+import functools
+import tensorflow as tf
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Total seconds and calls per timed stage, filled by timed() and timed_batches()
+STAGE_TIMES = {}
+
+# Generator seconds not yet attributed to a training step, read and reset by ProfileCallback
+_pending = {"seconds": 0.0}
+
+
+# Returns the peak resident set size of this process in MB, or None where it can't be read.
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return rss / 2 ** 20 if os.uname().sysname == "Darwin" else rss / 2 ** 10
+
+
+# Adds one call of a stage to STAGE_TIMES.
+def record(name, seconds):
+    total, calls = STAGE_TIMES.get(name, (0.0, 0))
+    STAGE_TIMES[name] = (total + seconds, calls + 1)
+    return
+
+
+# Decorator, times every call of a function as a named stage.
+def timed(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                record(name, seconds)
+                logging.info("%s time: %.2f s" % (name, seconds))
+
+        return wrapper
+
+    return decorator
+
+
+# Wraps a batch generator, timing each batch it produces.
+# The time is recorded under name and left for ProfileCallback to attribute to the running step.
+# With Keras prefetching, part of this time can overlap compute rather than stall it.
+def timed_batches(gen, name):
+    while True:
+        start = time.perf_counter()
+        batch = next(gen)
+        seconds = time.perf_counter() - start
+        record(name, seconds)
+        _pending["seconds"] += seconds
+        yield batch
+
+
+# Keras callback that writes per-step timings, per-epoch throughput and a run summary to a JSON lines file.
+# trace_steps is an optional (first, last) global step window to record with the TF profiler into trace_dir.
+# initial_epoch is the epoch a resumed run starts from: records of that epoch and later are dropped
+# from the file and the rest kept, like trim_log does for the CSV log.
+class ProfileCallback(tf.keras.callbacks.Callback):
+    def __init__(self, path, batch_size, trace_steps=None, trace_dir=None, initial_epoch=0):
+        super(ProfileCallback, self).__init__()
+        self.path = str(path)
+        self.batch_size = batch_size
+        self.initial_epoch = initial_epoch
+        self.trace_steps = trace_steps
+        self.trace_dir = str(trace_dir) if trace_dir is not None else self.path + "_trace"
+        self.tracing = False
+
+    def write(self, **fields):
+        self.log.write(json.dumps(fields) + "\n")
+        self.log.flush()
+
+    # Keeps the records of epochs before initial_epoch, and every stage and summary record of earlier runs.
+    def trim(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as log:
+            rows = [row for row in log if row.strip()]
+        keep = [row for row in rows if json.loads(row).get("epoch", -1) < self.initial_epoch]
+        with open(self.path, "w") as log:
+            log.writelines(keep)
+        return
+
+    def on_train_begin(self, logs=None):
+        if self.initial_epoch > 0:
+            self.trim()
+            self.log = open(self.path, "a")
+        else:
+            self.log = open(self.path, "w")
+        self.step = self.initial_epoch * ((self.params or {}).get("steps") or 0)
+        self.start = time.perf_counter()
+        self.last_end = None
+        self.totals = {"data": 0.0, "compute": 0.0, "steps": 0}
+        _pending["seconds"] = 0.0
+
+        # Loader and generator stages timed before training started
+        for name, (total, calls) in sorted(STAGE_TIMES.items()):
+            self.write(event="stage", name=name, seconds=total, calls=calls)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.epoch_start = time.perf_counter()
+        self.epoch_data = 0.0
+        self.epoch_steps = 0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        now = time.perf_counter()
+        self.gap = 0.0 if self.last_end is None else now - self.last_end
+        self.batch_start = now
+
+        if self.trace_steps is not None and self.step == self.trace_steps[0]:
+            tf.profiler.experimental.start(self.trace_dir)
+            self.tracing = True
+
+    def on_train_batch_end(self, batch, logs=None):
+        now = time.perf_counter()
+        step_time = now - self.batch_start
+        gen = min(_pending["seconds"], step_time)
+        _pending["seconds"] = 0.0
+        data = self.gap + gen
+        compute = step_time - gen
+
+        self.write(
+            event="step",
+            epoch=self.epoch,
+            step=self.step,
+            data_wait=data,
+            compute=compute,
+            loss=float(logs["loss"]) if logs and "loss" in logs else None,
+        )
+        self.totals["data"] += data
+        self.totals["compute"] += compute
+        self.totals["steps"] += 1
+        self.epoch_data += data
+        self.epoch_steps += 1
+        self.last_end = now
+
+        if self.tracing and self.step >= self.trace_steps[1]:
+            self.stop_trace()
+        self.step += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.perf_counter() - self.epoch_start
+        self.write(
+            event="epoch",
+            epoch=epoch,
+            seconds=seconds,
+            steps_per_sec=self.epoch_steps / seconds,
+            samples_per_sec=self.epoch_steps * self.batch_size / seconds,
+            data_fraction=self.epoch_data / seconds,
+            peak_rss_mb=peak_rss(),
+            val_loss=float(logs["val_loss"]) if logs and "val_loss" in logs else None,
+        )
+        # The gap across validation is not data wait for the next step
+        self.last_end = None
+
+    def on_train_end(self, logs=None):
+        if self.tracing:
+            self.stop_trace()
+
+        seconds = time.perf_counter() - self.start
+        steps = max(self.totals["steps"], 1)
+        self.write(
+            event="summary",
+            seconds=seconds,
+            steps=self.totals["steps"],
+            steps_per_sec=self.totals["steps"] / seconds,
+            samples_per_sec=self.totals["steps"] * self.batch_size / seconds,
+            mean_data_wait=self.totals["data"] / steps,
+            mean_compute=self.totals["compute"] / steps,
+            peak_rss_mb=peak_rss(),
+        )
+        self.log.close()
+        logging.info(
+            "profile: %.1f steps/s, %.0f%% data wait, peak RSS %s MB"
+            % (
+                self.totals["steps"] / seconds,
+                100.0 * self.totals["data"] / max(self.totals["data"] + self.totals["compute"], 1e-9),
+                peak_rss(),
+            )
+        )
+
+    def stop_trace(self):
+        tf.profiler.experimental.stop()
+        self.tracing = False
+        logging.info("profiler trace written to " + self.trace_dir)
+
+
+# Returns a ProfileCallback writing to the addrs key (COMP_PROF or REAL_PROF), or None if that address isn't set.
+# initial_epoch is the resume epoch, the log is then appended to.
+def profile_callback(cfg, ADDR, key, initial_epoch=0):
+    if cfg["addrs"].get(key) is None:
+        return None
+
+    trace = cfg["params"].get("PROFILE_STEPS")
+    return ProfileCallback(
+        ADDR / cfg["addrs"][key],
+        cfg["params"]["BATCH_SIZE"],
+        trace_steps=tuple(trace) if trace is not None else None,
+        initial_epoch=initial_epoch,
+    )
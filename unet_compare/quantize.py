@@ -0,0 +1,91 @@
+# Post-training int8 quantization of the complex and real U-Nets, for CPU serving.
+# Weights and activations are quantized to int8 in TFLite, with activation ranges calibrated on test slices.
+# CompConv2D layers are switched to their fused path first: real and imaginary parts go through one conv with one
+# [Rf | If] kernel, so both share a single quantized weight tensor and activation scale, as they share the float weights.
+# Each model is reported against its float32 original on the remaining test slices:
+# SSIM/NRMSE/PSNR through metrics(), per-slice latency and size, and whether the drop is within tolerance.
+
+import os
+import json
+import logging
+import numpy as np
+import tensorflow as tf
+from unet_compare.functions import CompConv2D, CUSTOM_OBJECTS, metrics, model_inputs
+from unet_compare.export import export_tflite, latency, size_mb
+
+
+# Switches every CompConv2D of a model to the fused path. Same weights and outputs, one kernel per layer.
+def fuse_complex(model):
+    for layer in model.submodules:
+        if isinstance(layer, CompConv2D):
+            layer.fused = True
+    return model
+
+
+# Writes an int8 TFLite model of model to path, calibrated on the calibration slices.
+def quantize_model(model, path, calibration):
+    return export_tflite(fuse_complex(model), path, "int8", calibration)
+
+
+# Predicts the evaluation slices and scores them like evaluate.py: outputs scaled by their max magnitude,
+# then metrics() against the references. Returns the summary row and the per-slice metrics.
+def score(model, dec, rec, batch_size):
+    pred = model.predict(dec, batch_size=batch_size)
+    pred = pred / np.max(np.abs(pred[:, :, :, 0] + 1j * pred[:, :, :, 1]))
+    per_slice = metrics(rec, pred)
+    row = {}
+    for ii, name in enumerate(["ssim", "nrmse", "psnr"]):
+        row[name + "_mean"] = float(per_slice[:, ii].mean())
+        row[name + "_std"] = float(per_slice[:, ii].std())
+    return row, per_slice
+
+
+# Quantizes each (name, Keras model path) in models into out_dir and reports it against the float32 model.
+# calibration slices set the activation ranges, dec/rec are held-out slices for metrics and latency.
+# A model passes when SSIM drops by at most ssim_tol and PSNR by at most psnr_tol dB.
+# TFLite runs on every core, like the float32 Keras model.
+def quant_report(
+    models, out_dir, calibration, dec, rec, ssim_tol=0.01, psnr_tol=0.5, batch_size=16, repeats=20
+):
+    os.makedirs(str(out_dir), exist_ok=True)
+    report = {}
+
+    for name, model_path in models:
+        tflite_path = os.path.join(str(out_dir), name + "_int8.tflite")
+        model = tf.keras.models.load_model(str(model_path), custom_objects=CUSTOM_OBJECTS)
+        quantize_model(model, tflite_path, model_inputs(model, calibration))
+        inputs = model_inputs(model, dec)
+
+        rows = {}
+        for variant, path in [("float32", str(model_path)), ("int8", tflite_path)]:
+            loaded, times = latency(path, inputs, batch_size, repeats, threads=os.cpu_count())
+            logging.info(name + " " + variant + ":")
+            row, _ = score(loaded, inputs, rec, batch_size)
+            row.update(times)
+            row["size_mb"] = size_mb(path)
+            rows[variant] = row
+
+        base, quant = rows["float32"], rows["int8"]
+        rows["ssim_drop"] = base["ssim_mean"] - quant["ssim_mean"]
+        rows["psnr_drop"] = base["psnr_mean"] - quant["psnr_mean"]
+        rows["speedup"] = base["slice_ms_batch_1"] / quant["slice_ms_batch_1"]
+        rows["size_ratio"] = base["size_mb"] / quant["size_mb"]
+        rows["within_tolerance"] = bool(rows["ssim_drop"] <= ssim_tol and rows["psnr_drop"] <= psnr_tol)
+        report[name] = rows
+
+        logging.info(
+            "%s int8: SSIM drop %.4f, PSNR drop %.2f dB, %.2fx faster at batch 1, %.2fx smaller, %s"
+            % (
+                name,
+                rows["ssim_drop"],
+                rows["psnr_drop"],
+                rows["speedup"],
+                rows["size_ratio"],
+                "within tolerance" if rows["within_tolerance"] else "OUTSIDE tolerance",
+            )
+        )
+
+    with open(os.path.join(str(out_dir), "quant_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    return report
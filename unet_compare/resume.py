@@ -0,0 +1,104 @@
+# Checkpoint and resume for comp_main and real_main, so a preempted job restarts where it stopped.
+# Every RESUME_EVERY epochs the model weights and optimizer state are saved with tf.train.CheckpointManager,
+# along with the epoch, EarlyStopping and ModelCheckpoint state, the numpy and python RNG states and the
+# number of batches the input pipeline has produced. state.json is written last, so it only names complete checkpoints.
+
+import os
+import json
+import pickle
+import random
+import logging
+import numpy as np
+import tensorflow as tf
+from unet_compare.distribute import out_path
+
+
+# Reads the resume state in a directory, None if there is nothing to resume from.
+def load_state(path):
+    state_path = os.path.join(str(path), "state.json")
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, "r") as f:
+        return json.load(f)
+
+
+# Returns (resume directory, state) for an addrs key such as COMP_RESUME.
+# The directory is None when resuming is off (no RESUME_EVERY or no address), state is None on a fresh run.
+# The RNG states are restored here, before the input pipeline draws anything.
+def resume_state(cfg, ADDR, key, strategy):
+    if not cfg["params"].get("RESUME_EVERY") or cfg["addrs"].get(key) is None:
+        return None, None
+
+    path = out_path(cfg, ADDR, key, strategy)
+    state = load_state(path)
+    if state is not None:
+        with open(os.path.join(str(path), "rng.pkl"), "rb") as f:
+            rng = pickle.load(f)
+        np.random.set_state(rng["numpy"])
+        random.setstate(rng["python"])
+
+    return path, state
+
+
+# Drops CSVLogger rows from epochs after the checkpoint, they are trained again.
+def trim_log(path, epoch):
+    if not os.path.exists(str(path)):
+        return
+    with open(str(path), "r") as log:
+        rows = log.readlines()
+    if len(rows) == 0:
+        return
+    col = rows[0].strip().split("|").index("epoch")
+    keep = [rows[0]] + [row for row in rows[1:] if row.strip() and int(row.split("|")[col]) < epoch]
+    with open(str(path), "w") as log:
+        log.writelines(keep)
+    return
+
+
+# Saves the training state every `every` epochs into path and restores it at the start of fit.
+# es and mc are the run's EarlyStopping and ModelCheckpoint, it must come after them in the callback list.
+# state is from resume_state, None on a fresh run.
+class ResumeCallback(tf.keras.callbacks.Callback):
+    def __init__(self, path, every, steps_per_epoch, es, mc, state=None):
+        super(ResumeCallback, self).__init__()
+        self.path = str(path)
+        self.every = every
+        self.steps_per_epoch = steps_per_epoch
+        self.es = es
+        self.mc = mc
+        self.state = state
+
+    def on_train_begin(self, logs=None):
+        self.checkpoint = tf.train.Checkpoint(model=self.model, optimizer=self.model.optimizer)
+        self.manager = tf.train.CheckpointManager(self.checkpoint, self.path, max_to_keep=2)
+        if self.state is None:
+            return
+
+        # Optimizer slots are created on the first step, their restore is deferred until then
+        self.checkpoint.restore(os.path.join(self.path, self.state["checkpoint"]))
+        self.es.wait = self.state["es_wait"]
+        self.es.best = self.state["es_best"]
+        self.mc.best = self.state["mc_best"]
+        logging.info("resumed from epoch " + str(self.state["epoch"]))
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.every != 0:
+            return
+
+        checkpoint = self.manager.save(checkpoint_number=epoch + 1)
+        with open(os.path.join(self.path, "rng.pkl"), "wb") as f:
+            pickle.dump({"numpy": np.random.get_state(), "python": random.getstate()}, f)
+
+        state = {
+            "epoch": epoch + 1,
+            "batches": (epoch + 1) * self.steps_per_epoch,
+            "checkpoint": os.path.basename(checkpoint),
+            "es_wait": self.es.wait,
+            "es_best": float(self.es.best),
+            "mc_best": float(self.mc.best),
+        }
+        tmp = os.path.join(self.path, "state.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, os.path.join(self.path, "state.json"))
+        logging.info("resume checkpoint: epoch " + str(epoch + 1))
@@ -0,0 +1,194 @@
+# Asyncio reconstruction server. Loads one trained model once and reconstructs undersampled k-space slices sent over TCP.
+# Concurrent requests are grouped into micro-batches: a batch runs when it is full or when its first request
+# has waited max_latency seconds. The model runs in a worker thread so the event loop keeps accepting requests.
+
+# Protocol, all integers little endian uint32:
+# Request: H, W, then H * W * 2 float32 k-space values (real, imag last axis), as stored in the scan files.
+# Unsampled k-space must be sent as exact zeros, a cascade is given the nonzero points as its sampling mask.
+# Response: H, W, then H * W * 2 float32 reconstruction values.
+# A request with H = W = 0 returns the server stats instead: length, then that many bytes of JSON.
+
+import time
+import json
+import struct
+import asyncio
+import logging
+import numpy as np
+from unet_compare.export import TFLiteModel, load_inference_model
+
+HEADER = struct.Struct("<II")
+
+
+# Undersampled k-space slice (H, W, 2) to the image-domain model input, as in load_slices.
+# Each slice is normalized by its own max magnitude, returned so the output can be scaled back.
+# with_mask adds the sampling mask as a third channel, for cascades (see mask_input).
+def preprocess(kspace, with_mask=False):
+    norm = np.sqrt(kspace.shape[0] * kspace.shape[1])
+    image = np.fft.ifft2((kspace[:, :, 0] + 1j * kspace[:, :, 1]) / norm)
+    scale = max(float(np.abs(image).max()), 1e-12)
+    image = image / scale
+    channels = [image.real, image.imag]
+    if with_mask:
+        channels.append(np.any(kspace != 0, axis=2))
+    return np.stack(channels, axis=2).astype(np.float32), scale
+
+
+# Latencies of served requests and counters, reported as p50/p99 and throughput.
+class Stats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.latencies = []
+        self.batches = 0
+
+    def report(self):
+        seconds = time.perf_counter() - self.start
+        lat = np.asarray(self.latencies) * 1e3
+        return {
+            "requests": len(lat),
+            "batches": self.batches,
+            "mean_batch": len(lat) / max(self.batches, 1),
+            "p50_ms": float(np.percentile(lat, 50)) if len(lat) else None,
+            "p99_ms": float(np.percentile(lat, 99)) if len(lat) else None,
+            "throughput": len(lat) / seconds,
+        }
+
+
+# Groups queued requests into micro-batches and runs them through the model.
+# Batches are padded up to the next power of two (at most max_batch), so a graph model sees a few input shapes
+# without computing max_batch slices for every lone request. Models that run one slice at a time get no padding.
+class Batcher:
+    def __init__(self, model, max_batch=16, max_latency=0.01):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.queue = asyncio.Queue()
+        self.stats = Stats()
+
+    # Batch size a group of n slices is padded to.
+    def bucket(self, n):
+        if isinstance(self.model, TFLiteModel):
+            return n
+        return min(2 ** int(np.ceil(np.log2(n))), self.max_batch)
+
+    # Queues one preprocessed slice, returns its model output.
+    async def submit(self, image):
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((image, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(items) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Slices of different shapes run as separate batches
+            for shape in set(image.shape for image, _ in items):
+                group = [(image, future) for image, future in items if image.shape == shape]
+                batch = np.zeros((self.bucket(len(group)),) + shape, dtype=np.float32)
+                batch[: len(group)] = np.stack([image for image, _ in group])
+                try:
+                    pred = await loop.run_in_executor(None, self.model.predict_on_batch, batch)
+                    pred = np.asarray(pred)
+                except Exception as err:
+                    for _, future in group:
+                        future.set_exception(err)
+                    continue
+                self.stats.batches += 1
+                for ii, (_, future) in enumerate(group):
+                    future.set_result(pred[ii])
+
+
+# Serves one connection, any number of requests in sequence.
+async def handle(batcher, reader, writer, with_mask=False):
+    try:
+        while True:
+            try:
+                H, W = HEADER.unpack(await reader.readexactly(HEADER.size))
+            except asyncio.IncompleteReadError:
+                break
+
+            if H == 0 and W == 0:
+                report = json.dumps(batcher.stats.report()).encode()
+                writer.write(struct.pack("<I", len(report)) + report)
+                await writer.drain()
+                continue
+
+            start = time.perf_counter()
+            data = await reader.readexactly(H * W * 2 * 4)
+            image, scale = preprocess(np.frombuffer(data, dtype="<f4").reshape(H, W, 2), with_mask)
+            pred = await batcher.submit(image)
+
+            writer.write(HEADER.pack(H, W) + (pred * scale).astype("<f4").tobytes())
+            await writer.drain()
+            batcher.stats.latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+# Loads a saved comp or real U-Net and serves it on host:port until cancelled.
+# with_mask is for cascades, which take the sampling mask as an input channel.
+async def serve(model_path, host="127.0.0.1", port=8765, max_batch=16, max_latency=0.01, with_mask=False):
+    model = load_inference_model(model_path)
+    batcher = Batcher(model, max_batch, max_latency)
+    batch_task = asyncio.ensure_future(batcher.run())
+
+    server = await asyncio.start_server(
+        lambda reader, writer: handle(batcher, reader, writer, with_mask), host, port
+    )
+    logging.info("serving " + str(model_path) + " on " + host + ":" + str(port))
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+        logging.info("server stats: " + json.dumps(batcher.stats.report()))
+
+
+# Stand-in client. Sends one slice per request from clients concurrent connections, returns the latency stats.
+# slices is an (N, H, W, 2) array of undersampled k-space, cycled through.
+async def load_test(slices, host="127.0.0.1", port=8765, clients=8, requests=100):
+    latencies = []
+
+    async def client(index):
+        reader, writer = await asyncio.open_connection(host, port)
+        for ii in range(index, requests, clients):
+            kspace = np.asarray(slices[ii % len(slices)], dtype="<f4")
+            start = time.perf_counter()
+            writer.write(HEADER.pack(kspace.shape[0], kspace.shape[1]) + kspace.tobytes())
+            await writer.drain()
+            H, W = HEADER.unpack(await reader.readexactly(HEADER.size))
+            await reader.readexactly(H * W * 2 * 4)
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(index) for index in range(clients)])
+    seconds = time.perf_counter() - start
+
+    # Server side stats, including batching
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(HEADER.pack(0, 0))
+    await writer.drain()
+    (length,) = struct.unpack("<I", await reader.readexactly(4))
+    server = json.loads((await reader.readexactly(length)).decode())
+    writer.close()
+
+    lat = np.asarray(latencies) * 1e3
+    return {
+        "requests": len(lat),
+        "clients": clients,
+        "p50_ms": float(np.percentile(lat, 50)),
+        "p99_ms": float(np.percentile(lat, 99)),
+        "throughput": len(lat) / seconds,
+        "server": server,
+    }
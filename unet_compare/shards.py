@@ -0,0 +1,144 @@
+# Sharded slice storage. A dataset is a directory of fixed-size float32 k-space shards plus an index.json
+# giving the slice shape, the slice count of every shard and the volume each slice came from.
+# Any slice is found from its global index, only the shards holding requested slices are read,
+# uncompressed shards through memory maps, and shards are read in parallel threads.
+# A plain glob of whole-volume .npy files opens as the same SliceStore, one shard per file.
+# A store returns raw k-space, the loaders (load_slices, inference.kspace_batches) turn it into model inputs.
+
+import os
+import json
+import glob
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+INDEX = "index.json"
+
+
+# Random access to the slices of a list of (slices, H, W, 2) shards.
+class SliceStore:
+    def __init__(self, paths, counts, slice_shape, workers=4):
+        self.paths = list(paths)
+        self.counts = np.asarray(counts, dtype=int)
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+        self.slice_shape = tuple(slice_shape)
+        self.workers = workers
+
+    # Opens a glob of .npy volumes, reading only the file headers.
+    @classmethod
+    def from_files(cls, files, workers=4):
+        files = sorted(files)
+        counts = np.zeros(len(files), dtype=int)
+        slice_shape = None
+        for ii in range(len(files)):
+            file_shape = np.load(files[ii], mmap_mode="r").shape
+            if slice_shape is not None and file_shape[1:] != slice_shape:
+                raise ValueError(
+                    "slice shape " + str(file_shape[1:3]) + " in " + str(files[ii]) + " does not match " + str(slice_shape[:2])
+                )
+            slice_shape = file_shape[1:]
+            counts[ii] = file_shape[0]
+        return cls(files, counts, slice_shape, workers)
+
+    # Opens a shard directory written by convert.
+    @classmethod
+    def open(cls, directory, workers=4):
+        with open(os.path.join(str(directory), INDEX), "r") as f:
+            index = json.load(f)
+        paths = [os.path.join(str(directory), shard["file"]) for shard in index["shards"]]
+        return cls(paths, [shard["count"] for shard in index["shards"]], index["slice_shape"], workers)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self),) + self.slice_shape
+
+    # Files whose contents determine the data, for cache keys.
+    @property
+    def files(self):
+        return self.paths
+
+    # Returns one shard, memory-mapped if uncompressed.
+    def shard(self, k):
+        if self.paths[k].endswith(".npz"):
+            with np.load(self.paths[k]) as shard:
+                return shard["kspace"]
+        return np.load(self.paths[k], mmap_mode="r")
+
+    # Yields (positions, slices) for every shard holding some of the global indexes.
+    # positions index into indexes, slices are read in sorted order within each shard, shards in parallel.
+    def chunks(self, indexes):
+        indexes = np.asarray(indexes, dtype=int)
+        shard_ids = np.searchsorted(self.offsets, indexes, side="right") - 1
+
+        def read(k):
+            pos = np.nonzero(shard_ids == k)[0]
+            local = indexes[pos] - self.offsets[k]
+            order = np.argsort(local)
+            return pos[order], np.asarray(self.shard(k)[local[order]], dtype=np.float32)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for pos, slices in pool.map(read, np.unique(shard_ids)):
+                yield pos, slices
+
+    # Reads slices by global index, returned in the order given.
+    def read(self, indexes):
+        indexes = np.asarray(indexes, dtype=int)
+        out = np.zeros((len(indexes),) + self.slice_shape, dtype=np.float32)
+        for pos, slices in self.chunks(indexes):
+            out[pos] = slices
+        return out
+
+
+# Returns the store for an addrs pattern: a shard directory if it holds an index.json, otherwise a glob of .npy files.
+def open_store(ADDR, pattern, workers=4):
+    path = ADDR / pattern
+    if os.path.exists(os.path.join(str(path), INDEX)):
+        return SliceStore.open(path, workers)
+    return SliceStore.from_files(glob.glob(str(path)), workers)
+
+
+# Converts whole-volume .npy files to a shard directory of shard_slices slices per shard, float32.
+# compress writes .npz shards, smaller on disk but each read loads a whole shard.
+def convert(files, out_dir, shard_slices=64, compress=False):
+    source = SliceStore.from_files(files)
+    os.makedirs(str(out_dir), exist_ok=True)
+
+    shards = []
+    buffer = []
+    sources = []
+
+    def flush():
+        name = "shard_%05d.%s" % (len(shards), "npz" if compress else "npy")
+        data = np.concatenate(buffer)
+        if compress:
+            np.savez_compressed(os.path.join(str(out_dir), name), kspace=data)
+        else:
+            np.save(os.path.join(str(out_dir), name), data)
+        shards.append({"file": name, "count": len(data), "sources": list(sources)})
+        del buffer[:]
+        del sources[:]
+
+    filled = 0
+    for ii, path in enumerate(source.paths):
+        volume = np.load(path, mmap_mode="r")
+        first = 0
+        while first < len(volume):
+            part = np.asarray(volume[first:first + shard_slices - filled], dtype=np.float32)
+            buffer.append(part)
+            # (volume file, first slice in it, slice count) for each run of slices in the shard
+            sources.append([os.path.basename(path), first, len(part)])
+            first += len(part)
+            filled += len(part)
+            if filled == shard_slices:
+                flush()
+                filled = 0
+    if filled > 0:
+        flush()
+
+    index = {"slice_shape": list(source.slice_shape), "slices": len(source), "shards": shards}
+    with open(os.path.join(str(out_dir), INDEX), "w") as f:
+        json.dump(index, f, indent=2)
+
+    return SliceStore.open(out_dir)
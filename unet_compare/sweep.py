@@ -0,0 +1,208 @@
+# Hyperparameter sweeps on one node. Data is loaded and preprocessed once per distinct ACCEL (which changes the masks)
+# and written as .npy files that every trial memory-maps read-only, so all workers share one copy through the page cache.
+# Trials run across a process pool and are pruned by successive halving on val_loss: every rung trains the
+# surviving trials up to MIN_EPOCHS * ETA^rung epochs, continuing from their saved models, and keeps the best 1/ETA.
+
+import os
+import copy
+import json
+import logging
+import itertools
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from unet_compare.functions import get_brains, mask_gen
+from unet_compare.evaluate import shared_array
+
+# Params a sweep can vary, KIND picks the comp or real U-Net
+SWEEP_PARAMS = [
+    "KIND",
+    "MOD",
+    "RE_MOD",
+    "LR",
+    "ACCEL",
+    "BATCH_SIZE",
+    "DEPTH",
+    "CONVS",
+    "COMPLEX_LAYERS",
+    "ACTIVATION",
+    "COMPLEX_BN",
+    "CASCADE",
+    "CASCADE_MOD",
+    "CASCADE_SHARED",
+]
+
+
+# Params only one kind of U-Net reads, dropped from the other kind's trials
+KIND_PARAMS = {
+    "comp": ["MOD", "COMPLEX_LAYERS", "ACTIVATION", "COMPLEX_BN"],
+    "real": ["RE_MOD"],
+}
+
+
+# Returns every distinct trial of the grid in cfg["sweep"], one dict of params each.
+# Params the trial's KIND doesn't read are dropped, so e.g. real trials differing only in MOD run once.
+def trial_grid(cfg):
+    names = [name for name in SWEEP_PARAMS if name in cfg["sweep"]]
+    values = [list(cfg["sweep"][name]) for name in names]
+
+    trials = []
+    seen = set()
+    for combo in itertools.product(*values):
+        trial = dict(zip(names, combo))
+        kind = trial.get("KIND", "comp")
+        for other, params in KIND_PARAMS.items():
+            if other != kind:
+                for name in params:
+                    trial.pop(name, None)
+
+        key = json.dumps(trial, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            trials.append(trial)
+
+    return trials
+
+
+# Worker. Trains one trial from initial_epoch up to epochs and saves it, returns its best val_loss.
+# The model is rebuilt on the first rung and reloaded with its optimizer state on later ones.
+def run_trial(number, trial, cfg, trial_dir, data, initial_epoch, epochs, threads):
+    import tensorflow as tf
+    from unet_compare.functions import (
+        model_builder,
+        model_inputs,
+        nrmse,
+        train_input,
+        CUSTOM_OBJECTS,
+    )
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    cfg = copy.deepcopy(cfg)
+    cfg["params"].update({k: v for k, v in trial.items() if k != "KIND"})
+    rec_train = np.load(data["rec_train"], mmap_mode="r")
+    dec_val = np.load(data["dec_val"], mmap_mode="r")
+    rec_val = np.load(data["rec_val"], mmap_mode="r")
+    mask = np.load(data["mask"])
+
+    model_path = os.path.join(trial_dir, "model")
+    if initial_epoch == 0:
+        builder = model_builder(cfg, trial.get("KIND", "comp"))
+        model = builder(cfg, H=rec_train.shape[1], W=rec_train.shape[2])
+        opt = tf.keras.optimizers.Adam(
+            lr=cfg["params"]["LR"],
+            beta_1=cfg["params"]["BETA_1"],
+            beta_2=cfg["params"]["BETA_2"],
+        )
+        model.compile(optimizer=opt, loss=nrmse)
+    else:
+        model = tf.keras.models.load_model(
+            model_path, custom_objects=CUSTOM_OBJECTS
+        )
+
+    steps = int(np.ceil(rec_train.shape[0] / cfg["params"]["BATCH_SIZE"]))
+    history = model.fit(
+        train_input(rec_train, mask, None, cfg, start=initial_epoch * steps),
+        epochs=epochs,
+        initial_epoch=initial_epoch,
+        steps_per_epoch=steps,
+        verbose=0,
+        validation_data=(model_inputs(model, dec_val), rec_val),
+    )
+    model.save(model_path)
+
+    return number, float(np.min(history.history["val_loss"]))
+
+
+# Loads and preprocesses the data once for one ACCEL, returns the paths workers memory-map it from.
+def shared_data(cfg, ADDR, tmp_dir):
+    mask_gen(ADDR, cfg)
+    mask, stats, dec_train, rec_train, dec_val, rec_val = get_brains(cfg, ADDR)
+
+    name = "accel%s" % cfg["params"]["ACCEL"]
+    mask_path = os.path.join(tmp_dir, name + "_mask.npy")
+    np.save(mask_path, mask)
+
+    return {
+        "rec_train": shared_array(rec_train, name + "_rec_train", tmp_dir),
+        "dec_val": shared_array(dec_val, name + "_dec_val", tmp_dir),
+        "rec_val": shared_array(rec_val, name + "_rec_val", tmp_dir),
+        "mask": mask_path,
+    }
+
+
+# Runs the sweep in cfg["sweep"] and writes every trial's rung results to SWEEP_OUT. Returns the results.
+# cfg must be a plain dict, e.g. from OmegaConf.to_container.
+def run_sweep(cfg, ADDR):
+    trials = trial_grid(cfg)
+    min_epochs = cfg["sweep"].get("MIN_EPOCHS", 5)
+    eta = cfg["sweep"].get("ETA", 3)
+    max_epochs = cfg["params"]["EPOCHS"]
+    workers = min(cfg["sweep"].get("WORKERS") or os.cpu_count(), len(trials))
+    out_dir = ADDR / cfg["addrs"]["SWEEP_DIR"]
+    os.makedirs(str(out_dir), exist_ok=True)
+    logging.info("sweep trials: " + str(len(trials)) + ", workers: " + str(workers))
+
+    results = [{"trial": trial, "rungs": []} for trial in trials]
+    with tempfile.TemporaryDirectory(dir=str(ADDR)) as tmp_dir:
+
+        # One data set per ACCEL, every other swept param shares it
+        data = {}
+        for accel in sorted(set(trial.get("ACCEL", cfg["params"]["ACCEL"]) for trial in trials)):
+            accel_cfg = copy.deepcopy(cfg)
+            accel_cfg["params"]["ACCEL"] = accel
+            # Loaded with the mask channel if any trial is a cascade, plain U-Nets drop it
+            cascades = [trial.get("CASCADE", cfg["params"].get("CASCADE")) for trial in trials]
+            accel_cfg["params"]["CASCADE"] = next((cascade for cascade in cascades if cascade), None)
+            data[accel] = shared_data(accel_cfg, ADDR, tmp_dir)
+
+        alive = list(range(len(trials)))
+        trained = 0
+        epochs = min(min_epochs, max_epochs)
+
+        # Spawned workers, TF does not survive a fork once it is initialized.
+        # Each rung gets a fresh pool sized to the surviving trials, so the cores are split between them again:
+        # TF's thread counts can't change once a worker has initialized it.
+        context = multiprocessing.get_context("spawn")
+        while True:
+            rung_workers = min(workers, len(alive))
+            threads = max(1, os.cpu_count() // rung_workers)
+            with ProcessPoolExecutor(max_workers=rung_workers, mp_context=context) as pool:
+                futures = [
+                    pool.submit(
+                        run_trial,
+                        number,
+                        trials[number],
+                        cfg,
+                        str(out_dir / ("trial_%03d" % number)),
+                        data[trials[number].get("ACCEL", cfg["params"]["ACCEL"])],
+                        trained,
+                        epochs,
+                        threads,
+                    )
+                    for number in alive
+                ]
+                losses = {}
+                for future in futures:
+                    number, loss = future.result()
+                    losses[number] = loss
+                    results[number]["rungs"].append({"epochs": epochs, "val_loss": loss})
+                    logging.info("trial %d %s: %d epochs, val_loss %.5f" % (number, trials[number], epochs, loss))
+
+            with open(str(out_dir / "sweep.json"), "w") as f:
+                json.dump(results, f, indent=2)
+
+            if epochs >= max_epochs or len(alive) == 1:
+                break
+
+            # Successive halving: keep the best 1/ETA, train them ETA times longer
+            alive = sorted(alive, key=lambda number: losses[number])[: max(1, len(alive) // eta)]
+            trained = epochs
+            epochs = min(epochs * eta, max_epochs)
+
+    best = min(alive, key=lambda number: losses[number])
+    logging.info("best trial %d %s, val_loss %.5f" % (best, trials[best], losses[best]))
+
+    return results